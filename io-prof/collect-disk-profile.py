@@ -1,7 +1,14 @@
 #!/bin/env python3
 
+import os
+import sys
+import csv
 import yaml
+import json
 import time
+import math
+import random
+import hashlib
 import subprocess
 import argparse
 
@@ -10,18 +17,51 @@ parser.add_argument('-w', dest='wloads', action='append', help='Workloads to run
 parser.add_argument('-p', dest='prl', choices=['dense', 'sparse'], default='dense', help='Parallelizm handling (default dense)')
 parser.add_argument('-s', dest='storage', default='/mnt', help='Storage to work on (default /mnt)')
 parser.add_argument('-l', dest='latency_goal', type=float, default=1.0, help='Latency goal (ms, default 1.0)')
+parser.add_argument('-lp', dest='latency_percentile', choices=['estimate', 'average', 'p50', 'p95', 'p99', 'p99.9', 'max'], default='estimate', help='Latency -l applies to (default estimate, which is parallelism / IOPS)')
 parser.add_argument('-S', dest='data_size', default='64GB', help='Data size (default 64GB)')
 parser.add_argument('-D', dest='duration', default=120, help='Duration of a single measurement (sec, default 120)')
 parser.add_argument('-P', dest='pause', default=16.0, type=float, help='Pause between measuremenets (sec, default 16)')
+parser.add_argument('-c', dest='shards', default='1', help='Comma-separated shard counts to profile each workload with (default 1)')
+parser.add_argument('-shard-split', dest='shard_split', choices=['per-shard', 'split'], default='per-shard', help='Whether parallelism is per shard or total over all shards, spread over them as evenly as it goes (default per-shard)')
+parser.add_argument('-search', choices=['grid', 'adaptive'], default='grid', help='How to find the latency goal frontier in mixed workloads (default grid)')
+parser.add_argument('-converge', action='store_true', help='Run io_tester in -sample long pieces and stop once results converge (-D is the upper limit)')
+parser.add_argument('-sample', type=int, default=5, help='Duration of a single sample in -converge mode (sec, default 5)')
+parser.add_argument('-tolerance', type=float, default=0.02, help='Relative 95%% confidence interval to stop at in -converge mode (default 0.02)')
+parser.add_argument('-min-samples', dest='min_samples', type=int, default=3, help='Minimal number of samples in -converge mode (default 3)')
+parser.add_argument('-settle', action='store_true', help='Instead of the fixed pause wait for the device to become idle (-P is the timeout)')
+parser.add_argument('-settle-window', dest='settle_window', type=float, default=1.0, help='How long the device should be idle to be considered settled (sec, default 1.0)')
+parser.add_argument('-cache', default=None, help='File to keep measurement results in and reuse them from')
+parser.add_argument('-cache-max-age', dest='cache_max_age', type=float, default=None, help='Ignore and drop cached results older than that (hours)')
+parser.add_argument('-cache-clear', dest='cache_clear', action='store_true', help='Drop all cached results before starting')
+parser.add_argument('-io-properties', dest='io_properties', default=None, help='Write seastar io-properties fitted from the results into this file')
+parser.add_argument('-sat-trials', dest='sat_trials', type=int, default=2, help='Maximum number of trials per saturation request size (default 2)')
+parser.add_argument('-sat-tolerance', dest='sat_tolerance', type=float, default=0.02, help='Relative 95%% confidence interval of saturation throughput to stop trials at (default 0.02)')
+parser.add_argument('-sat-resolution', dest='sat_resolution', type=float, default=1.25, help='Ratio of saturation knee bounds to stop bisection at (default 1.25)')
+parser.add_argument('-backend', choices=['io_tester', 'simulated'], default='io_tester', help='What runs the measurements (default io_tester)')
+parser.add_argument('-io-tester', dest='io_tester', default='../../seastar/build/dev/apps/io_tester/io_tester', help='Path to io_tester binary')
+parser.add_argument('-sim-device', dest='sim_device', default='', help='Simulated device model, comma-separated key=value (read_iops, write_iops, read_bw, write_bw, latency in usec, interference, noise)')
+parser.add_argument('-sim-seed', dest='sim_seed', type=int, default=0, help='Random seed of the simulated device (default 0)')
 parser.add_argument('-fast', action='store_true', help='Fast (and inaccurate) measurement (-d 32MB -D 1 -P 0.1)')
 parser.add_argument('-full', action='store_true', help='Show full stats at the end')
+parser.add_argument('-o', dest='output', default=None, help='Export results with run metadata into this file (.json or .csv)')
+parser.add_argument('-diff', nargs=2, metavar=('OLD', 'NEW'), default=None, help='Compare two JSON exports, exit with non-zero code on regressions')
+parser.add_argument('-diff-threshold', dest='diff_threshold', type=float, default=0.05, help='Relative change considered a regression (default 0.05)')
 args = parser.parse_args()
+args.shards = [ int(c) for c in args.shards.split(',') ]
 
 if args.fast:
     args.data_size = '32MB'
     args.duration = 1
     args.pause = 0.1
 
+# The warm-up piece and -min-samples samples have to fit into -D, and
+# io_tester doesn't run for less than a second
+if args.converge:
+    args.sample = min(args.sample, int(float(args.duration) / (args.min_samples + 1)))
+    if args.sample < 1:
+        print(f'-D {args.duration} is too short for -converge, measuring without it')
+        args.converge = False
+
 class table:
     def __init__(self, name, default = 0.0):
         self._name = name
@@ -53,6 +93,10 @@ class table:
                     skip = skip + f' {self._def}'
             print(ln)
 
+    # Cells as [rprl, wprl, value], without the default (0, 0) one
+    def export(self):
+        return { 'name': self._name, 'cells': [ [r, w, v] for (r, w), v in sorted(self._res.items()) if (r, w) != (0, 0) ] }
+
     def test_fill(self):
         self.add(1, 0, "1-0")
         self.add(2, 0, "2-0")
@@ -65,35 +109,455 @@ class table:
         self.show()
 
 
+# Results are keyed by everything that affects them: the workloads config,
+# duration, the storage (path and device) and the io_tester binary. The
+# file is rewritten after every new result, so an interrupted session can
+# be restarted and only measures what's missing.
+class measurement_cache:
+    def __init__(self, path, max_age, clear):
+        self._path = path
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+        if not clear and os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+        if max_age is not None:
+            now = time.time()
+            self._entries = { k: e for k, e in self._entries.items() if now - e['ts'] <= max_age * 3600 }
+        self._save()
+
+    @staticmethod
+    def environment(storage, io_tester):
+        if backend.simulated:
+            return backend.environment()
+        dev = os.stat(storage).st_dev
+        st = os.stat(io_tester)
+        return {
+            'storage': os.path.realpath(storage),
+            'device': f'{os.major(dev)}:{os.minor(dev)}',
+            'io_tester': { 'path': os.path.realpath(io_tester), 'size': st.st_size, 'mtime': st.st_mtime_ns },
+        }
+
+    def key(self, desc):
+        return hashlib.sha1(json.dumps(desc, sort_keys = True).encode()).hexdigest()
+
+    def get(self, desc):
+        e = self._entries.get(self.key(desc))
+        if e is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return e['result']
+
+    def put(self, desc, res):
+        self._entries[self.key(desc)] = { 'ts': time.time(), 'desc': desc, 'result': res }
+        self._save()
+
+    def _save(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self._path)
+
+    def show(self):
+        print(f'Cache {self._path}: {self._hits} hits, {self._misses} measured, {len(self._entries)} entries')
+
+
+# Student's t 0.975 quantiles for small numbers of degrees of freedom
+t_975 = [ 12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23 ]
+
+def mean_and_ci(vals):
+    n = len(vals)
+    mean = sum(vals) / n
+    if n < 2:
+        return (mean, math.inf)
+    sd = math.sqrt(sum([ (v - mean) ** 2 for v in vals ]) / (n - 1))
+    t = t_975[n - 2] if n - 2 < len(t_975) else 1.96
+    return (mean, t * sd / math.sqrt(n))
+
+
+# Averages numeric values of same-shaped results
+def average_results(results):
+    r0 = results[0]
+    if isinstance(r0, dict):
+        return { k: average_results([ r[k] for r in results ]) for k in r0 }
+    if isinstance(r0, (int, float)) and not isinstance(r0, bool):
+        return sum(results) / len(results)
+    return r0
+
+
+# Watches the block device the storage lives on via /proc/diskstats
+class device_monitor:
+    poll = 0.1                  # sec
+    quiet_bw = 1024 * 1024      # bytes/sec that are still considered idle
+
+    def __init__(self, storage):
+        self._name = self._find_device(storage)
+        self._settles = []
+        self._timeouts = 0
+        if self._name is None:
+            print(f'Cannot find block device for {storage}, will pause for fixed time')
+
+    @staticmethod
+    def _find_device(storage):
+        dev = os.stat(storage).st_dev
+        sysfs = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+        if not os.path.exists(sysfs):
+            return None
+        path = os.path.realpath(sysfs)
+        # Background activity is per disk, not per partition
+        if os.path.exists(os.path.join(path, 'partition')):
+            path = os.path.dirname(path)
+        return os.path.basename(path)
+
+    # Returns (requests in flight, sectors read and written)
+    def _sample(self):
+        with open('/proc/diskstats') as f:
+            for ln in f:
+                x = ln.split()
+                if x[2] == self._name:
+                    return (int(x[11]), int(x[5]) + int(x[9]))
+        return (0, 0)
+
+    def settle(self, window, timeout):
+        if self._name is None:
+            time.sleep(timeout)
+            return
+
+        start = time.monotonic()
+        prev_t = start
+        prev = self._sample()
+        quiet_since = None
+        while True:
+            time.sleep(device_monitor.poll)
+            now = time.monotonic()
+            cur = self._sample()
+            bw = (cur[1] - prev[1]) * 512 / (now - prev_t)
+            if cur[0] == 0 and bw < device_monitor.quiet_bw:
+                if quiet_since is None:
+                    quiet_since = now
+                if now - quiet_since >= window:
+                    break
+            else:
+                quiet_since = None
+            if now - start >= timeout:
+                self._timeouts += 1
+                break
+            prev, prev_t = cur, now
+
+        took = time.monotonic() - start
+        self._settles.append(took)
+        print(f'{self._name} settled in {took:.1f} sec')
+
+    def show(self):
+        if len(self._settles) > 0:
+            print(f'Device {self._name} settled {len(self._settles)} times, {sum(self._settles):.1f} sec total, ' +
+                  f'{sum(self._settles) / len(self._settles):.1f} avg, {max(self._settles):.1f} max, {self._timeouts} timeouts')
+
+
+# Sums IOPS and throughput of every workload over shards, latency average
+# is weighted by shards' IOPS and the rest of latencies are the worst ones.
+# Per-shard results are kept under 'shards'.
+def aggregate_shards(shards):
+    res = { 'shards': shards }
+    names = [ k for k in shards[0] if isinstance(shards[0][k], dict) ]
+    for n in names:
+        per = [ s[n] for s in shards if n in s ]
+        iops = [ float(p['IOPS']) for p in per ]
+        agg = {
+            'IOPS': sum(iops),
+            'throughput': sum([ float(p['throughput']) for p in per ]),
+        }
+        if all([ 'latencies' in p for p in per ]):
+            agg['latencies'] = {}
+            for st in per[0]['latencies']:
+                lats = [ float(p['latencies'][st]) for p in per ]
+                if st == 'average':
+                    agg['latencies'][st] = sum([ l * i for l, i in zip(lats, iops) ]) / sum(iops) if sum(iops) > 0 else max(lats)
+                else:
+                    agg['latencies'][st] = max(lats)
+        res[n] = agg
+    return res
+
+
+# Runs io_tester with the given workloads config and returns its output
+class io_tester_backend:
+    simulated = False
+
+    def __init__(self, path):
+        self._path = path
+
+    def path(self):
+        return self._path
+
+    # io_tester takes --duration as unsigned integer
+    def run(self, config, storage, shards, duration):
+        yaml.dump(config, open('conf.yaml', 'w'))
+        proc = subprocess.Popen([self._path, '--storage', storage, f'-c{shards}', '--conf', 'conf.yaml', '--duration', f'{math.ceil(float(duration))}', '--keep-files', 'true'], stdout=subprocess.PIPE)
+        return proc.communicate()[0]
+
+
+# Stands in for io_tester and prints the same YAML. The device is a single
+# queue serving requests one by one, each costing max(1 / iops, size / bw)
+# of the device time, plus the fixed latency every request spends outside
+# of the queue. Writes in the mix make reads more expensive in proportion
+# to their share of the device time times the interference. Workloads'
+# throughputs are found with approximate mean value analysis of the closed
+# network (Schweitzer), results are perturbed by Gaussian noise.
+class simulated_backend:
+    simulated = True
+    defaults = {
+        'read_iops': 400000.0,
+        'write_iops': 200000.0,
+        'read_bw': 2 * 1024 * 1024 * 1024,
+        'write_bw': 1024 * 1024 * 1024,
+        'latency': 100.0,
+        'interference': 0.3,
+        'noise': 0.02,
+    }
+
+    def __init__(self, model, seed):
+        self._model = dict(simulated_backend.defaults)
+        for kv in [ kv for kv in model.split(',') if kv != '' ]:
+            k, v = kv.split('=', 1)
+            if k not in self._model:
+                raise ValueError(f'Unknown simulated device parameter {k}')
+            self._model[k] = float(parse_size(v)) if k.endswith('_bw') else float(v)
+        self._seed = seed
+        self._rand = random.Random(seed)
+
+    def path(self):
+        return None
+
+    def environment(self):
+        return { 'simulated': self._model, 'seed': self._seed }
+
+    def _demand(self, w):
+        rqsz = parse_size(str(w['shard_info']['reqsize']))
+        op = 'write' if w['type'].endswith('write') else 'read'
+        return max(1.0 / self._model[f'{op}_iops'], rqsz / self._model[f'{op}_bw'])
+
+    # Returns requests per second and response time (sec) of every workload
+    def _solve(self, pops, demands, writes):
+        lat = self._model['latency'] / 1000000
+        qs = [ n / 2 for n in pops ]
+        for _ in range(1000):
+            tps = [ n / (lat + d * (1 + sum(qs) - q / n)) for n, d, q in zip(pops, demands, qs) ]
+            wshare = sum([ x * d for x, d, w in zip(tps, demands, writes) if w ])
+            util = sum([ x * d for x, d in zip(tps, demands) ])
+            wshare = wshare / util if util > 0 else 0.0
+            eff = [ d if w else d * (1 + self._model['interference'] * wshare) for d, w in zip(demands, writes) ]
+            rts = [ d * (1 + sum(qs) - q / n) for n, d, q in zip(pops, eff, qs) ]
+            tps = [ n / (lat + r) for n, r in zip(pops, rts) ]
+            nqs = [ x * r for x, r in zip(tps, rts) ]
+            done = max([ abs(a - b) for a, b in zip(qs, nqs) ]) < 1e-6
+            qs = nqs
+            if done:
+                break
+        return tps, [ lat + r for r in rts ]
+
+    @staticmethod
+    def _shards_of(w, shards):
+        return range(shards) if w['shards'] == 'all' else w['shards']
+
+    def run(self, config, storage, shards, duration):
+        pops = [ w['shard_info']['parallelism'] * len(self._shards_of(w, shards)) for w in config ]
+        demands = [ self._demand(w) for w in config ]
+        writes = [ w['type'].endswith('write') for w in config ]
+        tps, rts = self._solve(pops, demands, writes)
+
+        lat = self._model['latency']
+        out = []
+        for sh in range(shards):
+            res = { 'shard': sh }
+            for w, x, r in zip(config, tps, rts):
+                if sh not in self._shards_of(w, shards):
+                    continue
+                iops = x / len(self._shards_of(w, shards)) * max(0.0, self._rand.gauss(1.0, self._model['noise']))
+                avg = r * 1000000 * max(0.0, self._rand.gauss(1.0, self._model['noise']))
+                # Queueing part of the latency is exponential
+                pct = lambda p: lat + (avg - lat) * -math.log(1 - p)
+                res[w['name']] = {
+                    'IOPS': iops,
+                    'throughput': iops * parse_size(str(w['shard_info']['reqsize'])) / 1024,
+                    'latencies': { 'average': avg, 'p0.5': pct(0.5), 'p0.95': pct(0.95), 'p0.99': pct(0.99), 'p0.999': pct(0.999), 'max': pct(0.9999) },
+                    'stats': { 'total_requests': int(iops * float(duration)) },
+                }
+            out.append(res)
+        return ('---\n' + yaml.dump(out)).encode()
+
+
 class measurement:
-    def __init__(self, args):
+    unstable = []
+
+    def __init__(self, args, shards = 1):
         self._config = []
         self._data_size = args.data_size
         self._duration = args.duration
         self._pause = args.pause
-        self._io_tester = '../../seastar/build/dev/apps/io_tester/io_tester'
+        self._shards = shards
+        self._split = args.shard_split == 'split' and shards > 1
+        self._aliases = {}              # io_tester class name -> workload name
+        self._names = []
+        self._trial = 0
+        self._io_tester = backend.path()
 
+    # Repeated runs of the same config are different cache entries
+    def trial(self, n):
+        self._trial = n
+
+    # In split mode prl is the total over all shards. It's spread over them
+    # as evenly as it goes, shards that get one more request than the rest
+    # run a separate io_tester class, results of both are put back under
+    # the workload name.
     def add_workload(self, typ, rqsz, prl):
-        self._config.append({
-            'name': f'workload_{len(self._config)}',
-            'shards': 'all',
-            'data_size': self._data_size,
-            'type': typ,
-            'shard_info': {
-                'parallelism': prl,
-                'reqsize': rqsz,
-                'shares': 100
-            }
-        })
-        return self._config[-1]['name']
+        name = f'workload_{len(self._names)}'
+        self._names.append(name)
+        if self._split:
+            base, rem = divmod(prl, self._shards)
+            parts = [ (list(range(0, rem)), base + 1), (list(range(rem, self._shards)), base) ]
+        else:
+            parts = [ ('all', prl) ]
+        for shards, p in [ (sh, p) for sh, p in parts if len(sh) > 0 and p > 0 ]:
+            cname = name if name not in self._aliases else f'{name}_rest'
+            self._aliases[cname] = name
+            self._config.append({
+                'name': cname,
+                'shards': shards,
+                'data_size': self._data_size,
+                'type': typ,
+                'shard_info': {
+                    'parallelism': p,
+                    'reqsize': rqsz,
+                    'shares': 100
+                }
+            })
+        return name
+
+    # Requests the workload keeps in flight over all shards
+    def in_flight(self, name):
+        return sum([ c['shard_info']['parallelism'] * (self._shards if c['shards'] == 'all' else len(c['shards']))
+                     for c in self._config if self._aliases[c['name']] == name ])
+
+    def _describe(self):
+        desc = {
+            'config': self._config,
+            'duration': f'{self._duration}',
+            'env': measurement_cache.environment(args.storage, self._io_tester),
+        }
+        if self._shards != 1:
+            desc['shards'] = self._shards
+        if self._trial != 0:
+            desc['trial'] = self._trial
+        if args.converge:
+            desc['converge'] = { 'sample': args.sample, 'tolerance': args.tolerance, 'min_samples': args.min_samples }
+        return desc
 
     def run(self):
-        yaml.dump(self._config, open('conf.yaml', 'w'))
-        self._proc = subprocess.Popen([self._io_tester, '--storage', args.storage, '-c1', '--conf', 'conf.yaml', '--duration', f'{self._duration}', '--keep-files', 'true'], stdout=subprocess.PIPE)
-        res = self._proc.communicate()
-        time.sleep(self._pause)
-        res = res[0].split(b'---\n')[1]
-        return yaml.safe_load(res)[0]
+        if cache is not None:
+            desc = self._describe()
+            res = cache.get(desc)
+            if res is None:
+                res = self._run()
+                cache.put(desc, res)
+            elif not res.get('convergence', {}).get('converged', True):
+                measurement.unstable.append((self._config, res['convergence']))
+            return res
+        return self._run()
+
+    def _run(self):
+        if args.converge:
+            res = self._run_converging()
+        else:
+            res = self._run_io_tester(self._duration)
+        if backend.simulated:
+            pass
+        elif monitor is not None:
+            monitor.settle(args.settle_window, self._pause)
+        else:
+            time.sleep(self._pause)
+        return res
+
+    def _run_io_tester(self, duration):
+        res = backend.run(self._config, args.storage, self._shards, duration)
+        res = res.split(b'---\n')
+        assert len(res) > 1, 'io_tester produced no results'
+        res = yaml.safe_load(res[1])
+        for sh in res:
+            for cname, name in self._aliases.items():
+                if cname != name and cname in sh:
+                    sh[name] = sh.pop(cname)
+        res = aggregate_shards(res)
+        if self._shards > 1:
+            for i, sh in enumerate(res['shards']):
+                print(f'\tshard {i}: ' + ' '.join([ f'{n} {float(sh[n]["IOPS"]):.0f}' for n in self._names if n in sh ]))
+        return res
+
+    # io_tester only reports at exit, so samples are taken by running it in
+    # -sample long pieces back to back. The first piece warms the device up
+    # and is not accounted, but counts in -D. Stops when IOPS and throughput
+    # of every workload have their confidence interval within -tolerance of
+    # the mean, or when -D is spent. The latter is flagged as unstable.
+    def _run_converging(self):
+        names = self._names
+        total = float(self._duration)
+        self._run_io_tester(args.sample)
+        samples = []
+        spread = 0.0
+        while True:
+            samples.append(self._run_io_tester(args.sample))
+            spread = 0.0
+            for n in names:
+                for metric in ('IOPS', 'throughput'):
+                    mean, ci = mean_and_ci([ float(s[n][metric]) for s in samples ])
+                    spread = max(spread, ci / mean if mean > 0 else math.inf)
+            if len(samples) >= args.min_samples and spread <= args.tolerance:
+                converged = True
+                break
+            if (len(samples) + 2) * args.sample > total:
+                converged = False
+                break
+
+        res = average_results(samples)
+        res['convergence'] = { 'samples': len(samples), 'spread': spread, 'converged': converged }
+        if not converged:
+            print(f'UNSTABLE: {len(samples)} samples, spread {spread:.3f}')
+            measurement.unstable.append((self._config, res['convergence']))
+        else:
+            print(f'converged after {len(samples)} samples, spread {spread:.3f}')
+        return res
+
+
+# Names of io_tester's per-workload latencies (usec) as seen in -lp
+latency_stats = {
+    'average': 'average',
+    'p50': 'p0.5',
+    'p95': 'p0.95',
+    'p99': 'p0.99',
+    'p99.9': 'p0.999',
+    'max': 'max',
+}
+
+def get_latency(res, name, stat):
+    lat = res[name].get('latencies')
+    assert lat is not None, f'io_tester reported no latencies for {name}'
+    return float(lat[latency_stats[stat]]) / 1000
+
+# Latency estimate (ms) from the number of requests in flight, a workload
+# that completed nothing never fits the goal
+def estimate_latency(in_flight, iops):
+    return in_flight / iops * 1000 if iops > 0 else math.inf
+
+# Latency of several workloads as one. Average is weighted by IOPS (the
+# worst one is taken if none completed), for percentiles and max the
+# worst of the workloads is taken
+def combine_latencies(res, names, stat):
+    lats = [ get_latency(res, n, stat) for n in names ]
+    if stat == 'average':
+        iops = [ float(res[n]['IOPS']) for n in names ]
+        return sum([ l * i for l, i in zip(lats, iops) ]) / sum(iops) if sum(iops) > 0 else max(lats)
+    return max(lats)
 
 
 class profile:
@@ -103,10 +567,20 @@ class profile:
 
         def add_workloads(self, m, typ, rqsz, prl):
             self._name = m.add_workload(typ, rqsz, prl)
+            self._in_flight = m.in_flight(self._name)
+
+        def in_flight(self):
+            return self._in_flight
 
         def get_iops(self, res):
             return float(res[self._name]['IOPS'])
 
+        def get_latency(self, res, stat):
+            return get_latency(res, self._name, stat)
+
+        def names(self):
+            return [self._name]
+
         def name(self):
             return 'd' + self._name
 
@@ -129,22 +603,48 @@ class profile:
                 for i in range(0, self._max_workloads):
                     nm = m.add_workload(typ, rqsz, com + (1 if i < rem else 0))
                     self._names.append(nm)
+            self._in_flight = sum([ m.in_flight(n) for n in self._names ])
+
+        def in_flight(self):
+            return self._in_flight
 
         def get_iops(self, res):
             return sum([ float(res[n]['IOPS']) for n in self._names ])
 
+        def get_latency(self, res, stat):
+            return combine_latencies(res, self._names, stat)
+
+        def names(self):
+            return self._names
+
         def name(self):
             return f's{len(self._names)}_{self._typ}_{self._prl}'
 
-    def __init__(self, typ, rq_size_r, rq_size_w, args):
+    def __init__(self, typ, rq_size_r, rq_size_w, args, shards = 1):
         self._typ = typ
         self._req_size_r = rq_size_r
         self._req_size_w = rq_size_w
+        self._shards = shards
+        self._peak_riops = 0.0          # Max IOPS seen among points fitting the latency goal
+        self._peak_wiops = 0.0
+        self._shard_reads = {}          # shard -> table of its read IOPS
+        self._points = []               # (read iops, write iops, whether the goal was exceeded)
+        self._shard_writes = {}
+        self._shard_rlatencies = {}     # shard -> table of its read -lp latency
+        self._shard_wlatencies = {}
+        if shards != 1:
+            rq_size_w = f'{rq_size_w}:c{shards}'
         self._rdelays = table(f'read_delays:{typ}:{rq_size_r}:{rq_size_w}:{args.prl}')
         self._wdelays = table(f'write_delays:{typ}:{rq_size_r}:{rq_size_w}:{args.prl}')
         self._reads = table('read_iops')
         self._writes = table('write_iops')
+        self._frontier = table(f'frontier:{typ}:{rq_size_r}:{rq_size_w}:{args.prl}')
+        self._rlatencies = { st: table(f'read_{st}:{typ}:{rq_size_r}:{rq_size_w}:{args.prl}') for st in latency_stats }
+        self._wlatencies = { st: table(f'write_{st}:{typ}:{rq_size_r}:{rq_size_w}:{args.prl}') for st in latency_stats }
+        self._percentile = args.latency_percentile
         self._threshold = args.latency_goal
+        self._runs = 0
+        self._grid_runs = 0
         self._prl = None
         if args.prl == 'dense':
             self._prl = self.dense
@@ -153,6 +653,16 @@ class profile:
 
         self._args = args
 
+    # Records all the latencies io_tester reported and returns the one the
+    # goal is checked against
+    def _latency(self, wt, res, iops, tables, rprl, wprl):
+        if all([ 'latencies' in res[n] for n in wt.names() ]):
+            for st in latency_stats:
+                tables[st].add(rprl, wprl, wt.get_latency(res, st))
+        if self._percentile == 'estimate':
+            return estimate_latency(wt.in_flight(), iops)
+        return wt.get_latency(res, self._percentile)
+
     def _do_pure(self, direction, wtype):
         prl = 1
         if direction == 'read':
@@ -160,44 +670,83 @@ class profile:
         if direction == 'write':
             req_size = self._req_size_w
         while True:
-            m = measurement(self._args)
+            m = measurement(self._args, self._shards)
             wt = wtype()
             wt.add_workloads(m, self._typ + direction, req_size, prl)
             res = m.run()
             iops = wt.get_iops(res)
-            delay = prl / iops * 1000
-            print(f'{wt.name()} {iops} {delay} ms')
+            delay = estimate_latency(wt.in_flight(), iops)
             if direction == 'read':
                 self._rdelays.add(prl, 0, delay)
                 self._reads.add(prl, 0, iops)
+                delay = self._latency(wt, res, iops, self._rlatencies, prl, 0)
             if direction == 'write':
                 self._wdelays.add(0, prl, delay)
                 self._writes.add(0, prl, iops)
+                delay = self._latency(wt, res, iops, self._wlatencies, 0, prl)
+            print(f'{wt.name()} {iops} {delay} ms')
+            if direction == 'read':
+                self._points.append((iops, 0.0, delay > self._threshold))
+            else:
+                self._points.append((0.0, iops, delay > self._threshold))
+            if delay <= self._threshold:
+                if direction == 'read':
+                    self._peak_riops = max(self._peak_riops, iops)
+                else:
+                    self._peak_wiops = max(self._peak_wiops, iops)
             prl *= 2
             if delay > self._threshold or prl > 1024:
                 break
 
+    # Per-shard IOPS and latency. The latency is the -lp one, or the average
+    # io_tester reports if -lp is the estimate
+    def _shard_tables(self, direction, iops, lats, wt, res, rprl, wprl):
+        stat = self._percentile if self._percentile != 'estimate' else 'average'
+        for i, sh in enumerate(res.get('shards', [])):
+            if i not in iops:
+                iops[i] = table(f'{direction}_iops_shard{i}')
+                lats[i] = table(f'{direction}_{stat}_shard{i}')
+            names = [ n for n in wt.names() if n in sh ]
+            iops[i].add(rprl, wprl, sum([ float(sh[n]['IOPS']) for n in names ]))
+            if len(names) > 0 and all([ 'latencies' in sh[n] for n in names ]):
+                lats[i].add(rprl, wprl, combine_latencies(sh, names, stat))
+
+    def _measure_mixed(self, wtype, rprl, wprl):
+        m = measurement(self._args, self._shards)
+        reads = wtype()
+        reads.add_workloads(m, self._typ + 'read', self._req_size_r, rprl)
+        writes = wtype()
+        writes.add_workloads(m, self._typ + 'write', self._req_size_w, wprl)
+        res = m.run()
+        self._runs += 1
+        riops = reads.get_iops(res)
+        rdelay = estimate_latency(reads.in_flight(), riops)
+        wiops = writes.get_iops(res)
+        wdelay = estimate_latency(writes.in_flight(), wiops)
+        delay = rdelay + wdelay
+        print(f'{reads.name()} {rprl} {riops} {rdelay} ms {writes.name()} {wprl} {wiops} {wdelay} ms -> {delay} ms')
+        self._rdelays.add(rprl, wprl, rdelay)
+        self._reads.add(rprl, wprl, riops)
+        self._wdelays.add(rprl, wprl, wdelay)
+        self._writes.add(rprl, wprl, wiops)
+        rlat = self._latency(reads, res, riops, self._rlatencies, rprl, wprl)
+        wlat = self._latency(writes, res, wiops, self._wlatencies, rprl, wprl)
+        if self._percentile != 'estimate':
+            print(f'\t{self._percentile} read {rlat} ms write {wlat} ms')
+        if self._shards > 1:
+            self._shard_tables('read', self._shard_reads, self._shard_rlatencies, reads, res, rprl, wprl)
+            self._shard_tables('write', self._shard_writes, self._shard_wlatencies, writes, res, rprl, wprl)
+        self._points.append((riops, wiops, rlat > self._threshold or wlat > self._threshold))
+        if rlat <= self._threshold and wlat <= self._threshold:
+            self._peak_riops = max(self._peak_riops, riops)
+            self._peak_wiops = max(self._peak_wiops, wiops)
+        return (rlat, wlat)
+
     def _do_mixed(self, wtype):
         rprl = 1
         wprl = 1
         while True:
-            m = measurement(self._args)
-            reads = wtype()
-            reads.add_workloads(m, self._typ + 'read', self._req_size_r, rprl)
-            writes = wtype()
-            writes.add_workloads(m, self._typ + 'write', self._req_size_w, wprl)
-            res = m.run()
-            riops = reads.get_iops(res)
-            rdelay = rprl / riops * 1000
-            wiops = writes.get_iops(res)
-            wdelay = wprl / wiops * 1000
-            delay = (rprl / riops + wprl / wiops) * 1000
-            print(f'{reads.name()} {rprl} {riops} {rdelay} ms {writes.name()} {wprl} {wiops} {wdelay} ms -> {delay} ms')
-            self._rdelays.add(rprl, wprl, rdelay)
-            self._reads.add(rprl, wprl, riops)
-            self._wdelays.add(rprl, wprl, wdelay)
-            self._writes.add(rprl, wprl, wiops)
-
+            rdelay, wdelay = self._measure_mixed(wtype, rprl, wprl)
             wprl *= 2
             if rdelay > self._threshold or wdelay > self._threshold or wprl > 1024:
                 if wprl == 2 or rprl > 1024:
@@ -206,24 +755,152 @@ class profile:
                 rprl *= 2
                 wprl = 1
 
+    # Finds the largest wprl that keeps both delays within the goal for each
+    # rprl row. Delays grow with parallelism, so the frontier only moves left
+    # as rprl grows and each row is searched below where the previous one
+    # failed, starting from the previous row's frontier. The search stops
+    # when the bracket is narrower than max_ratio, the frontier is then
+    # interpolated between the last fitting and the first failing points.
+    def _do_mixed_adaptive(self, wtype):
+        max_prl = 1024
+        max_ratio = 1.5
+
+        prev_lo = None
+        prev_hi = None          # The smallest failing wprl seen so far
+        rprl = 1
+        while rprl <= max_prl:
+            lo, dlo = 0, None   # Nothing is known to fit yet
+            hi, dhi = prev_hi, None
+            probe = prev_lo
+            while lo < max_prl and (hi is None or (hi - lo > 1 and (lo == 0 or hi > lo * max_ratio))):
+                if probe is None:
+                    if lo == 0:
+                        probe = 1
+                    elif hi is None:
+                        probe = max_prl
+                    else:
+                        probe = max(int(math.sqrt(lo * hi)), lo + 1)
+                d = max(self._measure_mixed(wtype, rprl, probe))
+                if d > self._threshold:
+                    hi, dhi = probe, d
+                else:
+                    lo, dlo = probe, d
+                probe = None
+
+            if lo == 0:
+                self._grid_runs += 1
+                break
+
+            frontier = lo
+            if dhi is not None:
+                frontier = lo + (hi - lo) * (self._threshold - dlo) / (dhi - dlo)
+            self._frontier.add(rprl, 0, frontier)
+            print(f'r{rprl} frontier w{frontier:.1f} (w{lo} fits, w{hi} does not)')
+
+            # The doubling grid measures all powers of two up to the first
+            # failing one
+            self._grid_runs += min(int(math.log2(lo)) + 2, int(math.log2(max_prl)) + 1)
+            prev_lo, prev_hi = lo, hi
+            rprl *= 2
+
+        print(f'{self._runs} measurements, grid search would take {self._grid_runs}, saved {self._grid_runs - self._runs}')
+
     def collect(self):
         #self._do_pure('read', self._prl)
         #self._do_pure('write', self._prl)
-        self._do_mixed(self._prl)
+        if self._args.search == 'adaptive':
+            self._do_mixed_adaptive(self._prl)
+        else:
+            self._do_mixed(self._prl)
+
+    def points(self):
+        return self._points
+
+    def _tables(self):
+        tables = {
+            'read_delays': self._rdelays,
+            'write_delays': self._wdelays,
+            'read_iops': self._reads,
+            'write_iops': self._writes,
+            'frontier': self._frontier,
+        }
+        for st in latency_stats:
+            tables[f'read_{st}'] = self._rlatencies[st]
+            tables[f'write_{st}'] = self._wlatencies[st]
+        for i in self._shard_reads:
+            tables[f'read_iops_shard{i}'] = self._shard_reads[i]
+            tables[f'write_iops_shard{i}'] = self._shard_writes[i]
+            tables[f'read_latency_shard{i}'] = self._shard_rlatencies[i]
+            tables[f'write_latency_shard{i}'] = self._shard_wlatencies[i]
+        return tables
+
+    def export(self):
+        tables = { k: t.export() for k, t in self._tables().items() }
+        return {
+            'kind': 'profile',
+            'key': f'{self.scaling_key()}:c{self._shards}',
+            'type': self._typ,
+            'req_size_r': self._req_size_r,
+            'req_size_w': self._req_size_w,
+            'shards': self._shards,
+            'tables': { k: t for k, t in tables.items() if len(t['cells']) > 0 },
+        }
+
+    def typ(self):
+        return self._typ
+
+    def request_sizes(self):
+        return (parse_size(self._req_size_r), parse_size(self._req_size_w))
+
+    def shards(self):
+        return self._shards
+
+    def scaling_key(self):
+        return f'{self._typ}:{self._req_size_r}:{self._req_size_w}'
+
+    def scaling(self):
+        return (self._shards, self._peak_riops, self._peak_wiops)
 
     def show(self):
-        print(f"========[ {self._typ}:{self._req_size_r}:{self._req_size_w} ]========")
+        shards = f':c{self._shards}' if self._shards != 1 else ''
+        print(f"========[ {self._typ}:{self._req_size_r}:{self._req_size_w}{shards} ]========")
         self._rdelays.show()
         self._wdelays.show()
+        if self._percentile != 'estimate':
+            self._rlatencies[self._percentile].show()
+            self._wlatencies[self._percentile].show()
+        if self._args.search == 'adaptive':
+            self._frontier.show()
         if self._args.full:
             self._reads.show()
             self._writes.show()
+            for st in latency_stats:
+                if st != self._percentile:
+                    self._rlatencies[st].show()
+                    self._wlatencies[st].show()
+            for i in sorted(self._shard_reads):
+                self._shard_reads[i].show()
+                self._shard_writes[i].show()
+                self._shard_rlatencies[i].show()
+                self._shard_wlatencies[i].show()
 
 
+# Throughput at request sizes, the knee is the smallest size that
+# gets within max_deviation of the throughput at the largest size.
+# Sizes the throughput deviates at bound the knee from below.
 class sat_row:
-    def __init__(self, rqsz, tp):
+    max_deviation = 0.04
+
+    def __init__(self, rqsz, tp, ci, trials):
         self._target = tp
-        self._row = [(rqsz, tp)]
+        self._row = { rqsz: (tp, ci, trials) }
+        self._lo = 0
+        self._hi = rqsz
+        # Relative deviation of a single run, as seen at the first size
+        if trials > 1 and tp > 0:
+            self._noise = ci * math.sqrt(trials) / (t_975[trials - 2] if trials - 2 < len(t_975) else 1.96) / tp
+        else:
+            self._noise = sat_row.max_deviation
 
     def _deviation(self, val):
         if val > self._target:
@@ -231,47 +908,109 @@ class sat_row:
         else:
             return (self._target - val) / self._target
 
-    def add(self, rqsz, tp):
-        self._row.append((rqsz, tp))
-        dev = self._deviation(tp)
-        return dev > 0.04
+    def deviates(self, tp):
+        return self._deviation(tp) > sat_row.max_deviation
+
+    # A single run is enough if it's off the threshold by more than the noise
+    def clear(self, tp):
+        return abs(self._deviation(tp) - sat_row.max_deviation) > 2 * self._noise
+
+    def add(self, rqsz, tp, ci, trials):
+        self._row[rqsz] = (tp, ci, trials)
+        if self.deviates(tp):
+            self._lo = max(self._lo, rqsz)
+            return True
+        self._hi = min(self._hi, rqsz)
+        return False
+
+    def bounds(self):
+        return (self._lo, self._hi)
+
+    def trials(self):
+        return sum([ x[2] for x in self._row.values() ])
 
     def _reqsz(self, sz):
-        if sz < 1024:
+        if sz < 1024 or sz % 1024 != 0:
             return f'{sz}'
         sz = int(sz / 1024)
-        if sz < 1024:
+        if sz < 1024 or sz % 1024 != 0:
             return f'{sz}k'
         sz = int(sz / 1024)
         return f'{sz}M'
 
+    def export(self, typ):
+        return {
+            'knee': self._hi,
+            'knee_bounds': [ self._lo, self._hi ],
+            'points': [ [sz, x[0], self._deviation(x[0]), x[1], x[2]] for sz, x in sorted(self._row.items(), reverse = True) ],
+        }
+
+    def max_throughput(self):
+        return max([ x[0] for x in self._row.values() ])
+
     def format(self, typ):
-        fmt = f'{typ}: {self._reqsz(self._row[-2][0])}\n'
-        fmt += '\n'.join(f'{self._reqsz(x[0])} {x[1]} {int(self._deviation(x[1])*100)}' for x in self._row)
+        lo = self._reqsz(self._lo) if self._lo > 0 else '?'
+        fmt = f'{typ}: {self._reqsz(self._hi)} ({lo}..{self._reqsz(self._hi)}, {self.trials()} runs)\n'
+        fmt += '\n'.join(f'{self._reqsz(sz)} {x[0]} {int(self._deviation(x[0])*100)} +-{x[1] / x[0] * 100 if x[0] > 0 else 0:.1f}% x{x[2]}' for sz, x in sorted(self._row.items(), reverse = True))
         return fmt
 
 class saturation:
+    min_size = 1024
+
     def __init__(self, args):
         self._args = args
 
-    def _measure_one(self, typ, reqsz):
-        while True:
-            m = measurement(self._args)
-            nm = m.add_workload('seq' + typ, reqsz, 1)
-            res = m.run()
-            return float(res[nm]['throughput'])
+    def _measure_one(self, typ, reqsz, trial):
+        m = measurement(self._args)
+        m.trial(trial)
+        nm = m.add_workload('seq' + typ, reqsz, 1)
+        res = m.run()
+        return float(res[nm]['throughput'])
 
+    # Repeats the measurement until the throughput confidence interval is
+    # within -sat-tolerance or, if the row is given, until it's clear on
+    # which side of the deviation threshold the throughput is. Sizes far
+    # from the threshold are measured once.
+    def _point(self, typ, reqsz, row = None):
+        tps = []
+        while len(tps) < self._args.sat_trials:
+            tps.append(self._measure_one(typ, reqsz, len(tps)))
+            mean, ci = mean_and_ci(tps)
+            if len(tps) == 1:
+                if row is not None and row.clear(mean):
+                    break
+                continue
+            if ci <= mean * self._args.sat_tolerance:
+                break
+            if row is not None and row.deviates(mean + ci) == row.deviates(mean - ci):
+                break
+        return (mean, ci if len(tps) > 1 else 0.0, len(tps))
+
+    @staticmethod
+    def _align(sz):
+        al = 4096 if sz >= 4096 else 512
+        return int(sz / al) * al
+
+    # Goes down by 4x steps until the throughput deviates, then bisects
+    # the [deviating, not deviating] bracket (geometrically, so sizes need
+    # not be powers of two) until its bounds are -sat-resolution apart
     def _measure(self, typ, init_sz):
-        tp_tgt = self._measure_one(typ, init_sz)
-        stats = sat_row(init_sz, tp_tgt)
+        stats = sat_row(init_sz, *self._point(typ, init_sz))
 
-        sz = int(init_sz / 2)
-        while sz >= 1024:
-            tp = self._measure_one(typ, sz)
-            if stats.add(sz, tp):
+        sz = init_sz
+        while sz > saturation.min_size:
+            sz = max(saturation.min_size, int(sz / 4))
+            if stats.add(sz, *self._point(typ, sz, stats)):
                 break
 
-            sz = int(sz / 2)
+        while True:
+            lo, hi = stats.bounds()
+            if lo == 0 or hi / lo <= self._args.sat_resolution:
+                break
+            mid = self._align(math.sqrt(lo * hi))
+            if mid <= lo or mid >= hi:
+                break
+            stats.add(mid, *self._point(typ, mid, stats))
 
         return stats
 
@@ -279,26 +1018,284 @@ class saturation:
         self._reads = self._measure('read', 32 * 1024 * 1024)
         self._writes = self._measure('write', 2 * 1024 * 1024)
 
+    def export(self):
+        return { 'kind': 'saturation', 'key': 'saturation', 'read': self._reads.export('read'), 'write': self._writes.export('write') }
+
+    # Bytes per second, io_tester reports throughput in kB/s
+    def bandwidth(self):
+        return (self._reads.max_throughput() * 1024, self._writes.max_throughput() * 1024)
+
     def show(self):
         print(self._reads.format('read'))
         print(self._writes.format('write'))
+        print(f'saturation: {self._reads.trials() + self._writes.trials()} runs')
+
+
+def parse_size(sz):
+    for sfx, mult in (('kB', 1024), ('MB', 1024 * 1024), ('GB', 1024 * 1024 * 1024)):
+        if sz.endswith(sfx):
+            return int(float(sz[:-len(sfx)]) * mult)
+    return int(sz)
+
+
+# Fits the linear cost model seastar's IO scheduler uses, where a saturated
+# disk satisfies reads / read_limit + writes / write_limit = 1, to a set of
+# (reads, writes) points with least squares over a = 1 / read_limit and
+# b = 1 / write_limit. Returns the limits, the RMS of the model residuals
+# and limits' relative 95% confidence intervals.
+def fit_cost_model(points):
+    srr = sum([ r * r for r, w in points ])
+    sww = sum([ w * w for r, w in points ])
+    srw = sum([ r * w for r, w in points ])
+    sr = sum([ r for r, w in points ])
+    sw = sum([ w for r, w in points ])
+    det = srr * sww - srw * srw
+    if det <= 1e-9 * srr * sww:
+        # Pure reads and/or writes, each limit is on its own
+        a = sr / srr if srr > 0 else 0.0
+        b = sw / sww if sww > 0 else 0.0
+        inv = (1 / srr if srr > 0 else 0.0, 1 / sww if sww > 0 else 0.0)
+    else:
+        a = (sr * sww - sw * srw) / det
+        b = (sw * srr - sr * srw) / det
+        inv = (sww / det, srr / det)
+
+    res = [ a * r + b * w - 1 for r, w in points ]
+    rms = math.sqrt(sum([ e * e for e in res ]) / len(res))
+    dof = len(points) - 2
+    sigma2 = sum([ e * e for e in res ]) / dof if dof > 0 else math.inf
+
+    def limit(x, var):
+        if x <= 0:
+            return (None, None)
+        return (1 / x, 1.96 * math.sqrt(sigma2 * var) / x if var > 0 else None)
+
+    return (limit(a, inv[0]), limit(b, inv[1]), rms)
+
+
+def mountpoint(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+# Builds io-properties out of the collected results. IOPS limits come from
+# the profile with the smallest requests, bandwidth limits from saturation
+# if it was run and from the profile with the largest requests otherwise.
+# Only points that exceeded the latency goal are used for fitting, as the
+# model describes a saturated disk, unless there are too few of them.
+class io_properties:
+    def __init__(self, profs):
+        self._profs = [ p for p in profs if isinstance(p, profile) and p.shards() == args.shards[0] ]
+        self._sat = next((p for p in profs if isinstance(p, saturation)), None)
+        self._props = {}
+
+    def _fit(self, prof, mult):
+        pts = [ (r * mult[0], w * mult[1]) for r, w, over in prof.points() if over ]
+        if len(pts) < 2:
+            pts = [ (r * mult[0], w * mult[1]) for r, w, over in prof.points() ]
+        if len(pts) < 2:
+            print(f'\tnot enough points to fit {prof.typ()}:{prof.request_sizes()[0]}:{prof.request_sizes()[1]}')
+            return None
+        rd, wr, rms = fit_cost_model(pts)
+        return (rd, wr, f'{prof.typ()}:{prof.request_sizes()[0]}:{prof.request_sizes()[1]}, {len(pts)} points, rms {rms:.3f}')
+
+    def _set(self, key, limit, how):
+        val, ci = limit
+        if val is None:
+            return
+        self._props[key] = int(val)
+        conf = f' +-{ci * 100:.1f}%' if ci is not None else ''
+        print(f'\t{key}: {int(val)}{conf} ({how})')
+
+    def collect(self):
+        print('========[ io-properties ]========')
+        if len(self._profs) > 0:
+            fit = self._fit(min(self._profs, key = lambda p : sum(p.request_sizes())), (1, 1))
+            if fit is not None:
+                self._set('read_iops', fit[0], fit[2])
+                self._set('write_iops', fit[1], fit[2])
+
+        if self._sat is not None:
+            rbw, wbw = self._sat.bandwidth()
+            self._set('read_bandwidth', (rbw, None), 'saturation')
+            self._set('write_bandwidth', (wbw, None), 'saturation')
+        elif len(self._profs) > 0:
+            prof = max(self._profs, key = lambda p : sum(p.request_sizes()))
+            fit = self._fit(prof, prof.request_sizes())
+            if fit is not None:
+                self._set('read_bandwidth', fit[0], fit[2])
+                self._set('write_bandwidth', fit[1], fit[2])
+
+    def write(self, path):
+        disk = { 'mountpoint': mountpoint(args.storage) }
+        for key in ('read_iops', 'read_bandwidth', 'write_iops', 'write_bandwidth'):
+            if key in self._props:
+                disk[key] = self._props[key]
+        with open(path, 'w') as f:
+            yaml.dump({ 'disks': [ disk ] }, f, sort_keys = False)
+
+def run_metadata():
+    dev = device_monitor._find_device(args.storage) if not backend.simulated else None
+    model = None
+    if dev is not None and os.path.exists(f'/sys/block/{dev}/device/model'):
+        with open(f'/sys/block/{dev}/device/model') as f:
+            model = f.read().strip()
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': os.uname().nodename,
+        'kernel': os.uname().release,
+        'device': dev,
+        'model': model,
+        'env': measurement_cache.environment(args.storage, backend.path()),
+        'args': { k: v for k, v in vars(args).items() if k not in ('output', 'diff', 'diff_threshold') },
+    }
+
+
+def export_results(path, profs):
+    res = { 'metadata': run_metadata(), 'results': [ p.export() for p in profs ] }
+    if path.endswith('.csv'):
+        with open(path, 'w', newline = '') as f:
+            for k, v in res['metadata'].items():
+                f.write(f'# {k}: {json.dumps(v)}\n')
+            wr = csv.writer(f)
+            wr.writerow(['key', 'table', 'rprl_or_type', 'wprl_or_reqsize', 'value'])
+            for r in res['results']:
+                if r['kind'] == 'profile':
+                    for tn, t in r['tables'].items():
+                        for rprl, wprl, v in t['cells']:
+                            wr.writerow([r['key'], tn, rprl, wprl, v])
+                else:
+                    for typ in ('read', 'write'):
+                        for pt in r[typ]['points']:
+                            wr.writerow([r['key'], 'throughput', typ, pt[0], pt[1]])
+    else:
+        with open(path, 'w') as f:
+            json.dump(res, f, indent = 1)
+
+
+# IOPS and frontier regress when they go down, latencies when they go up
+def diff_regressed(table, old, new, thr):
+    if table.endswith('iops') or '_iops_shard' in table or table == 'frontier':
+        return new < old * (1 - thr)
+    return new > old * (1 + thr)
+
+
+def diff_results(old_path, new_path, thr):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    old_res = { r['key']: r for r in old['results'] }
+    regressions = 0
+    compared = 0
+    for nr in new['results']:
+        orr = old_res.get(nr['key'])
+        if orr is None:
+            print(f'{nr["key"]}: only in {new_path}')
+            continue
+
+        if nr['kind'] == 'profile':
+            for tn, t in nr['tables'].items():
+                if tn not in orr['tables']:
+                    continue
+                ocells = { (r, w): v for r, w, v in orr['tables'][tn]['cells'] }
+                for r, w, v in t['cells']:
+                    if (r, w) not in ocells:
+                        continue
+                    compared += 1
+                    ov = ocells[(r, w)]
+                    if diff_regressed(tn, ov, v, thr):
+                        regressions += 1
+                        print(f'REGRESSION {nr["key"]} {tn} r{r} w{w}: {ov} -> {v} ({(v - ov) / ov * 100 if ov else math.inf:+.1f}%)')
+        else:
+            for typ in ('read', 'write'):
+                opts = { pt[0]: pt[1] for pt in orr[typ]['points'] }
+                for sz, tp in [ pt[:2] for pt in nr[typ]['points'] ]:
+                    if sz not in opts:
+                        continue
+                    compared += 1
+                    if tp < opts[sz] * (1 - thr):
+                        regressions += 1
+                        print(f'REGRESSION saturation {typ} {sz}: {opts[sz]} -> {tp} ({(tp - opts[sz]) / opts[sz] * 100:+.1f}%)')
+                if orr[typ]['knee'] != nr[typ]['knee']:
+                    print(f'saturation {typ} knee moved {orr[typ]["knee"]} -> {nr[typ]["knee"]}')
+
+    for key in old_res:
+        if key not in [ r['key'] for r in new['results'] ]:
+            print(f'{key}: only in {old_path}')
+
+    print(f'{compared} points compared, {regressions} regressions above {thr * 100:.1f}%')
+    return regressions
+
+
+if args.diff is not None:
+    sys.exit(1 if diff_results(args.diff[0], args.diff[1], args.diff_threshold) > 0 else 0)
+
+if args.backend == 'simulated':
+    backend = simulated_backend(args.sim_device, args.sim_seed)
+else:
+    backend = io_tester_backend(args.io_tester)
+
+monitor = None
+if args.settle and not backend.simulated:
+    monitor = device_monitor(args.storage)
+
+cache = None
+if args.cache is not None:
+    cache = measurement_cache(args.cache, args.cache_max_age, args.cache_clear)
 
 profs = []
 for w in args.wloads:
     if w == 'saturate':
         profs.append(saturation(args))
-    elif w == 'throughput':
-        profs.append(profile('seq', '128kB', '128kB', args))
-    elif w == 'iops':
-        profs.append(profile('rand', '4kB', '4kB', args))
-    else:
-        wp = w.split(':')
-        if len(wp) == 2:
-            profs.append(profile(wp[0], wp[1]+'kB', wp[1]+'kB', args))
-        if len(wp) == 3:
-            profs.append(profile(wp[0], wp[1]+'kB', wp[2]+'kB', args))
+        continue
+    for c in args.shards:
+        if w == 'throughput':
+            profs.append(profile('seq', '128kB', '128kB', args, c))
+        elif w == 'iops':
+            profs.append(profile('rand', '4kB', '4kB', args, c))
+        else:
+            wp = w.split(':')
+            if len(wp) == 2:
+                profs.append(profile(wp[0], wp[1]+'kB', wp[1]+'kB', args, c))
+            if len(wp) == 3:
+                profs.append(profile(wp[0], wp[1]+'kB', wp[2]+'kB', args, c))
 
 for wl in profs:
     wl.collect()
 for wl in profs:
     wl.show()
+
+if args.output is not None:
+    export_results(args.output, profs)
+
+if args.io_properties is not None:
+    iop = io_properties(profs)
+    iop.collect()
+    iop.write(args.io_properties)
+
+if len(args.shards) > 1:
+    scaling = {}
+    for wl in profs:
+        if isinstance(wl, profile):
+            scaling.setdefault(wl.scaling_key(), []).append(wl.scaling())
+    for key, points in scaling.items():
+        print(f'========[ {key} shards scaling ]========')
+        base_r = points[0][1] / points[0][0] if points[0][1] > 0 else None
+        base_w = points[0][2] / points[0][0] if points[0][2] > 0 else None
+        for c, riops, wiops in points:
+            eff_r = f' ({riops / (base_r * c):.2f} efficiency)' if base_r else ''
+            eff_w = f' ({wiops / (base_w * c):.2f} efficiency)' if base_w else ''
+            print(f'c{c}: read {riops:.0f} iops{eff_r} write {wiops:.0f} iops{eff_w}')
+if cache is not None:
+    cache.show()
+if monitor is not None:
+    monitor.show()
+if len(measurement.unstable) > 0:
+    print(f'{len(measurement.unstable)} unstable measurements:')
+    for cfg, conv in measurement.unstable:
+        wls = ', '.join([ f'{c["type"]}:{c["shard_info"]["reqsize"]}:{c["shard_info"]["parallelism"]}' for c in cfg ])
+        print(f'\t{wls}: {conv["samples"]} samples, spread {conv["spread"]:.3f}')
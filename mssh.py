@@ -1,8 +1,16 @@
 #!/bin/env python3
 
 import os
+import sys
+import time
+import shlex
+import signal
+import asyncio
+import base64
+import difflib
+import hashlib
+import tempfile
 import argparse
-import subprocess
 import colorama
 
 colorama.init(autoreset=True)
@@ -10,63 +18,523 @@ colorama.init(autoreset=True)
 parser = argparse.ArgumentParser(description='MSSH options')
 parser.add_argument('hosts', type=str, help='List of hosts (colon-separated)')
 parser.add_argument('-i', dest='identity', type=str, help='Identity file (passed to ssh as is)')
+parser.add_argument('-o', dest='output_dir', type=str, default=None, help='Write each host\'s stdout and stderr into $dir/$host.{out,err} instead of printing them')
+parser.add_argument('-j', dest='jobs', type=int, default=32, help='How many hosts to work on at the same time (default 32, 0 means all)')
+parser.add_argument('-timeout', type=float, default=None, help='Kill the ssh/scp if it takes longer than that (sec), applies to every attempt')
+parser.add_argument('-connect-timeout', dest='connect_timeout', type=int, default=10, help='Timeout of establishing ssh connection (sec, default 10)')
+parser.add_argument('-retries', type=int, default=0, help='How many times to retry a host when ssh fails to connect or times out (default 0)')
+parser.add_argument('-no-mux', dest='mux', action='store_false', help='Don\'t share ssh connections via ControlMaster')
+parser.add_argument('-persist', type=int, default=600, help='How long to keep shared ssh connection open after mssh exits (sec, default 600)')
+parser.add_argument('-copy-mode', dest='copy_mode', choices=['direct', 'tree', 'chain'], default='direct', help='How --copy distributes the file: from here to every host, relayed by hosts that have it already, or streamed through all hosts in a chain (default direct)')
+parser.add_argument('-compress', choices=['none', 'gzip', 'zstd', 'lz4'], default='none', help='Compress the file on the wire when copying (default none)')
+parser.add_argument('-checksum', action='store_true', help='Skip hosts that have the file with the same sha256 already and verify it after copying')
+parser.add_argument('-a', dest='aggregate', action='store_true', help='Group hosts with identical output and exit code, print every distinct output once, diffs for outliers and a per-host summary')
+parser.add_argument('-timing', action='store_true', help='Print per-host connect and run times at the end')
 parser.add_argument('command', nargs=argparse.REMAINDER)
 args = parser.parse_args()
 
+host_colors = [ colorama.Fore.CYAN, colorama.Fore.MAGENTA, colorama.Fore.YELLOW, colorama.Fore.BLUE,
+                colorama.Fore.LIGHTCYAN_EX, colorama.Fore.LIGHTMAGENTA_EX, colorama.Fore.LIGHTYELLOW_EX, colorama.Fore.LIGHTBLUE_EX ]
+
+def report_finish(r, ret):
+    times = f'connect {r.connect_time():.2f}s, run {r.run_time():.2f}s' if r.connect_time() is not None else f'run {r.run_time():.2f}s'
+    if r.attempts() > 1:
+        times += f', {r.attempts()} attempts'
+    if ret == 0:
+        print(colorama.Fore.GREEN + f'Host {r.host()} finished ({times})')
+    else:
+        print(colorama.Fore.RED + f'Host {r.host()} finished with {ret} ({times})')
+
+# Prints output lines as they come, prefixed with the colored host name
+class stream_output:
+    def __init__(self, remotes):
+        self._width = max([ len(r.host()) for r in remotes ])
+
+    def _prefix(self, r):
+        return host_colors[r.index() % len(host_colors)] + f'{r.host():<{self._width}}' + colorama.Style.RESET_ALL
+
+    def line(self, r, stream, data, eol = True):
+        out = sys.stdout if stream == 'stdout' else sys.stderr
+        out.write(f'{self._prefix(r)} | {data.decode("utf-8", errors="replace")}\n')
+        out.flush()
+
+    def start(self, r):
+        pass
+
+    def finish(self, r, ret):
+        report_finish(r, ret)
+
+    def close(self):
+        pass
+
+# Keeps stdout of auxiliary commands, which is expected to be short
+class capture_output:
+    def __init__(self):
+        self._lines = []
+
+    def line(self, r, stream, data, eol = True):
+        if stream == 'stdout':
+            self._lines.append(data)
+
+    def lines(self):
+        return self._lines
+
+# Node of the trie all hosts' outputs are kept in, line by line. Hosts
+# with the same output end up in the same node and outputs that start
+# the same share their beginning, so memory only grows with distinct
+# output lines, however many hosts print them.
+class output_node:
+    __slots__ = ('parent', 'line', 'children')
+
+    def __init__(self, parent, line):
+        self.parent = parent
+        self.line = line
+        self.children = {}
+
+    def child(self, line):
+        c = self.children.get(line)
+        if c is None:
+            c = output_node(self, line)
+            self.children[line] = c
+        return c
+
+    def lines(self):
+        res = []
+        n = self
+        while n.parent is not None:
+            res.append(n.line)
+            n = n.parent
+        return list(reversed(res))
+
+# Groups hosts by output (stdout and stderr separately, as their relative
+# order is not stable) and exit code as they finish
+class aggregate_output:
+    def __init__(self, remotes):
+        self._roots = { 'stdout': output_node(None, None), 'stderr': output_node(None, None) }
+        self._cur = {}
+        self._groups = {}
+        self._group_of = {}
+
+    def start(self, r):
+        for s in ('stdout', 'stderr'):
+            self._cur[(r.index(), s)] = self._roots[s]
+
+    def line(self, r, stream, data, eol = True):
+        k = (r.index(), stream)
+        self._cur[k] = self._cur.get(k, self._roots[stream]).child((data, eol))
+
+    def finish(self, r, ret):
+        key = (self._cur.pop((r.index(), 'stdout'), self._roots['stdout']), self._cur.pop((r.index(), 'stderr'), self._roots['stderr']), ret)
+        hosts = self._groups.setdefault(key, [])
+        hosts.append(r)
+        self._group_of[r.index()] = key
+        report_finish(r, ret)
+        if len(hosts) > 1:
+            print(f'\tsame as {hosts[0].host()}')
+
+    @staticmethod
+    def _text(node):
+        return [ (ln.decode('utf-8', errors='replace') if eol else ln.decode('utf-8', errors='replace') + ' [no newline]') for ln, eol in node.lines() ]
+
+    @staticmethod
+    def _digest(key):
+        h = hashlib.sha256()
+        for n in key[:2]:
+            for ln, eol in n.lines():
+                h.update(ln + (b'\n' if eol else b''))
+            h.update(b'\0')
+        h.update(str(key[2]).encode())
+        return h.hexdigest()[:12]
+
+    def _groups_sorted(self):
+        return sorted(self._groups.items(), key = lambda g: (-len(g[1]), g[1][0].index()))
+
+    def group(self, r):
+        for i, (key, hosts) in enumerate(self._groups_sorted()):
+            if key == self._group_of.get(r.index()):
+                return i + 1
+        return None
+
+    # The biggest group is printed in full, the rest as diffs against it
+    def close(self):
+        groups = self._groups_sorted()
+        if len(groups) == 0:
+            return
+        main = groups[0][0]
+        for i, (key, hosts) in enumerate(groups):
+            color = colorama.Fore.GREEN if key[2] == 0 else colorama.Fore.RED
+            print(color + f'=== group {i + 1}: {len(hosts)} host(s), exit {key[2]}, {self._digest(key)}: ' + ','.join([ h.host() for h in hosts ]))
+            for s, n in zip(('stdout', 'stderr'), key[:2]):
+                if i == 0:
+                    if n.parent is not None:
+                        print(colorama.Fore.CYAN + s)
+                        print('\n'.join(self._text(n)))
+                elif n != main[0 if s == 'stdout' else 1]:
+                    print(colorama.Fore.CYAN + f'{s} vs group 1')
+                    diff = difflib.unified_diff(self._text(main[0 if s == 'stdout' else 1]), self._text(n), 'group 1', f'group {i + 1}', n = 1, lineterm = '')
+                    print('\n'.join(list(diff)[2:]))
+
+# Writes output straight into per-host files
+class file_output:
+    def __init__(self, remotes, path):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._files = {}
+
+    # Files are (re)created on every attempt, so that a retry doesn't
+    # leave the failed attempt's output behind, and only as many of them
+    # as there are hosts running are open at a time
+    def start(self, r):
+        for s, ext in (('stdout', 'out'), ('stderr', 'err')):
+            f = self._files.pop((r.index(), s), None)
+            if f is not None:
+                f.close()
+            self._files[(r.index(), s)] = open(os.path.join(self._path, f'{r.host()}.{ext}'), 'wb')
+
+    def line(self, r, stream, data, eol = True):
+        self._files[(r.index(), stream)].write(data + b'\n' if eol else data)
+
+    def finish(self, r, ret):
+        if (r.index(), 'stdout') not in self._files:
+            self.start(r)
+        for s in ('stdout', 'stderr'):
+            self._files.pop((r.index(), s)).close()
+        report_finish(r, ret)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+# Exit code ssh and scp report their own errors with
+ssh_error = 255
+timed_out = -1
+
 class remote:
+    # Lines longer than that are split, so that memory stays bounded
+    max_line = 64 * 1024
+
     def _user_and_host(self):
         return f'{self._user}@{self._host}' if self._user is not None else self._host
 
-    def _execute_cmd(self, args):
-        cmd = ['ssh']
+    # With connection sharing the first ssh to a host becomes the master
+    # and stays in background for -persist seconds, so the next commands
+    # (and next mssh runs) skip the handshake
+    def _ssh_opts(self):
+        opts = ['-o', f'ConnectTimeout={self._args.connect_timeout}']
         if self._identity is not None:
-            cmd += ['-i', self._identity]
+            opts += ['-i', self._identity]
+        if self._args.mux:
+            opts += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/mssh-%C', '-o', f'ControlPersist={self._args.persist}']
+        return opts
+
+    def _execute_cmd(self, args, forward_agent = False):
+        cmd = ['ssh'] + self._ssh_opts()
+        if forward_agent:
+            cmd += ['-A']
         cmd += [ self._user_and_host() ]
         cmd += args
         return cmd
 
     def _copy_cmd(self, args):
-        cmd = ['scp']
-        if self._identity is not None:
-            cmd += ['-i', self._identity]
+        cmd = ['scp'] + self._ssh_opts()
         cmd += [args[0]]
         args.append(os.path.basename(args[0]))
         cmd += [ f'{self._user_and_host()}:{args[1]}' ]
         return cmd
 
-    def _format_command(self):
+    def _format_command(self, command):
         def fmt(a):
             return a if not (' ' in a or '\t' in a) else f'"{a}"'
-        return ' '.join([ fmt(s) for s in self._command ])
+        return ' '.join([ fmt(s) for s in command ])
 
-    def __init__(self, user, host, args):
+    def __init__(self, user, host, index, args):
         self._host = host
         self._user = user
+        self._index = index
+        self._args = args
         self._identity = args.identity
+        self._attempts = 0
+        self._connect_time = None
+        self._run_time = 0.0
         if args.command[0] == '--copy':
             self._command = self._copy_cmd(args.command[1:])
         else:
             self._command = self._execute_cmd(args.command)
 
-    def start(self):
-        self._sub = subprocess.Popen(self._command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f'Running {self._format_command()}')
+    def host(self):
+        return self._host
 
-    def join(self):
-        out, err = self._sub.communicate()
-        self._out = out
-        self._err = err
+    def user_and_host(self):
+        return self._user_and_host()
 
-    def report(self):
-        ret = self._sub.wait()
-        if ret == 0:
-            print(colorama.Fore.GREEN + f'Host {self._host} finished')
-        else:
-            print(colorama.Fore.RED + f'Host {self._host} finished with {ret}')
-        print(colorama.Fore.CYAN + 'stdout ' + '-'*80)
-        print(self._out.decode('utf-8'))
-        print(colorama.Fore.CYAN + 'stderr' + '-'*80)
-        print(self._err.decode('utf-8'))
+    def ssh_cmd(self, args, forward_agent = False):
+        return self._execute_cmd(args, forward_agent)
+
+    def index(self):
+        return self._index
+
+    def attempts(self):
+        return self._attempts
+
+    def connect_time(self):
+        return self._connect_time
+
+    def run_time(self):
+        return self._run_time
+
+    async def _pump(self, reader, stream, output):
+        buf = b''
+        while True:
+            chunk = await reader.read(remote.max_line)
+            if not chunk:
+                break
+            buf += chunk
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for ln in lines:
+                output.line(self, stream, ln)
+            while len(buf) >= remote.max_line:
+                output.line(self, stream, buf[:remote.max_line], False)
+                buf = buf[remote.max_line:]
+        if buf:
+            output.line(self, stream, buf, False)
+
+    # The process runs in its own group, so that killing it on timeout
+    # also kills whatever it spawned and could keep the pipes open
+    async def _wait(self, sub, waiter, output):
+        try:
+            return await asyncio.wait_for(waiter, self._args.timeout)
+        except asyncio.TimeoutError:
+            os.killpg(sub.pid, signal.SIGKILL)
+            await sub.wait()
+            output.line(self, 'stderr', f'timed out after {self._args.timeout} sec'.encode())
+            return timed_out
+
+    async def _exec(self, cmd, output):
+        sub = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL, start_new_session=True,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        async def communicate():
+            await asyncio.gather(self._pump(sub.stdout, 'stdout', output), self._pump(sub.stderr, 'stderr', output))
+            return await sub.wait()
+        return await self._wait(sub, communicate(), output)
+
+    # Connecting is done separately, by running 'true' over the shared
+    # connection, so that the time it takes is seen on its own. The master
+    # connection this ssh may leave in background inherits its stderr, so
+    # it goes to a file rather than to a pipe that would never be closed
+    async def _connect(self, output):
+        with tempfile.TemporaryFile() as err:
+            sub = await asyncio.create_subprocess_exec('ssh', *self._ssh_opts(), self._user_and_host(), 'true', start_new_session=True,
+                                                       stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=err)
+            ret = await self._wait(sub, sub.wait(), output)
+            if ret != 0:
+                err.seek(0)
+                for ln in err.read().splitlines():
+                    output.line(self, 'stderr', ln)
+            return ret
+
+    async def _attempt(self, command, output):
+        self._attempts += 1
+        output.start(self)
+        if self._args.mux:
+            start = time.monotonic()
+            ret = await self._connect(output)
+            self._connect_time = time.monotonic() - start
+            if ret != 0:
+                return ret
+        start = time.monotonic()
+        ret = await self._exec(command, output)
+        self._run_time = time.monotonic() - start
+        return ret
+
+    # Runs a command on the host quietly, returns exit code and stdout lines
+    async def query(self, args):
+        out = capture_output()
+        ret = await self._exec(self._execute_cmd(args), out)
+        return (ret, out.lines())
+
+    # For hosts that got their copy as a part of another host's command
+    def copied(self, output, ret, run_time):
+        self._attempts = 1
+        self._run_time = run_time
+        output.finish(self, ret)
+
+    # Only failures of ssh itself are retried, failed commands are not
+    async def run(self, output, command = None):
+        command = command if command is not None else self._command
+        print(f'Running {self._format_command(command)}')
+        while True:
+            ret = await self._attempt(command, output)
+            if ret not in (ssh_error, timed_out) or self._attempts > self._args.retries:
+                break
+            print(colorama.Fore.YELLOW + f'Host {self._host} failed with {ret}, retrying')
+        output.finish(self, ret)
+        return ret
+
+async def run_all(remotes, output, jobs):
+    queue = asyncio.Queue()
+    for r in remotes:
+        queue.put_nowait(r)
+    rets = {}
+
+    async def worker():
+        while not queue.empty():
+            r = queue.get_nowait()
+            rets[r.index()] = await r.run(output)
+
+    try:
+        await asyncio.gather(*[ worker() for _ in range(jobs if jobs > 0 else len(remotes)) ])
+    finally:
+        output.close()
+    return [ rets[r.index()] for r in remotes ]
+
+compressors = {
+    'none': ('cat', 'cat'),
+    'gzip': ('gzip -1 -c', 'gzip -d -c'),
+    'zstd': ('zstd -1 -c -T0', 'zstd -d -c'),
+    'lz4': ('lz4 -c', 'lz4 -d -c'),
+}
+
+# Copies a file to hosts without pushing every copy through the local
+# uplink. In tree mode every host that has the file (and this one) sends
+# it to one more host at a time, so the number of hosts having it doubles
+# with every round. In chain mode the file is streamed through all hosts
+# at once, each one keeping a copy and passing it on to the next. Hosts
+# talk to each other with the forwarded ssh agent. Files are written
+# under a temporary name and renamed once complete.
+class distributor:
+    def __init__(self, remotes, args):
+        self._remotes = remotes
+        self._args = args
+        self._src = args.command[1]
+        self._dest = args.command[2] if len(args.command) > 2 else os.path.basename(args.command[1])
+        self._comp, self._decomp = compressors[args.compress]
+
+    def _read(self, path):
+        return f'{self._comp} < {shlex.quote(path)}'
+
+    # The temporary name has the writing shell's pid in it, so that hosts
+    # sharing the destination directory don't step on each other
+    def _write(self):
+        tmp = shlex.quote(self._dest + '.mssh-tmp') + '.$$'
+        return f'{self._decomp} > {tmp} && mv {tmp} {shlex.quote(self._dest)}'
+
+    def _hop(self, r, cmd):
+        return f'ssh -o BatchMode=yes -o StrictHostKeyChecking=accept-new {shlex.quote(r.user_and_host())} {shlex.quote(cmd)}'
+
+    def _send_cmd(self, src, dst):
+        if src is None:
+            return ['sh', '-c', f'{self._read(self._src)} | {shlex.join(dst.ssh_cmd([self._write()]))}']
+        return src.ssh_cmd([f'{self._read(self._dest)} | {self._hop(dst, self._write())}'], forward_agent = True)
+
+    def _local_sha256(self):
+        h = hashlib.sha256()
+        with open(self._src, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    async def _remote_sha256(self, r):
+        ret, out = await r.query([f'sha256sum {shlex.quote(self._dest)} 2>/dev/null'])
+        return out[0].split()[0].decode() if ret == 0 and len(out) > 0 else None
+
+    async def _remote_size(self, r):
+        ret, out = await r.query([f'stat -c %s {shlex.quote(self._dest)} 2>/dev/null'])
+        return int(out[0]) if ret == 0 and len(out) > 0 else None
+
+    async def _verify(self, targets):
+        if self._args.checksum:
+            sums = await asyncio.gather(*[ self._remote_sha256(r) for r in targets ])
+            return [ 0 if s == self._sha256 else 1 for s in sums ]
+        size = os.stat(self._src).st_size
+        sizes = await asyncio.gather(*[ self._remote_size(r) for r in targets ])
+        return [ 0 if s == size else 1 for s in sizes ]
+
+    async def _tree(self, targets, holders, rets, output):
+        sources = asyncio.Queue()
+        # This host is the only source in direct mode, so it serves -j hosts at once
+        for _ in range((self._args.jobs if self._args.jobs > 0 else len(targets)) if self._args.copy_mode == 'direct' else 1):
+            sources.put_nowait(None)
+        for r in holders:
+            sources.put_nowait(r)
+
+        async def send(src, dst):
+            ret = await dst.run(output, self._send_cmd(src, dst))
+            if ret == 0 and self._args.checksum:
+                ret = (await self._verify([dst]))[0]
+            rets[dst.index()] = ret
+            sources.put_nowait(src)
+            if ret == 0:
+                sources.put_nowait(dst)
+
+        tasks = []
+        for dst in targets:
+            src = await sources.get()
+            tasks.append(asyncio.create_task(send(src, dst)))
+        await asyncio.gather(*tasks)
+
+    # Every host in the chain runs the same script that keeps a copy and
+    # passes the stream on to the next host along with the rest of the
+    # list. The script travels base64-encoded in $1, so that quoting does
+    # not pile up with every hop.
+    def _chain_cmd(self, hosts):
+        script = f"""
+self=$1
+shift
+if [ $# -gt 0 ]; then
+    next=$1
+    shift
+    tee -p >(ssh -o BatchMode=yes -o StrictHostKeyChecking=accept-new "$next" "bash -c 'eval \\"\\$(echo \\$1 | base64 -d)\\"' mssh-copy $self $*")
+else
+    cat
+fi | {self._write()}
+"""
+        b64 = base64.b64encode(script.encode()).decode()
+        return f'bash -c \'eval "$(echo $1 | base64 -d)"\' mssh-copy {b64} ' + ' '.join([ shlex.quote(h) for h in hosts ])
+
+    async def _chain(self, targets, rets, output):
+        first = targets[0]
+        cmd = self._chain_cmd([ r.user_and_host() for r in targets[1:] ])
+        ret = await first.run(output, ['sh', '-c', f'{self._read(self._src)} | {shlex.join(first.ssh_cmd([cmd], forward_agent = True))}'])
+        # The chain fails as a whole, see which hosts got the file
+        verified = await self._verify(targets)
+        for r, v in zip(targets, verified):
+            rets[r.index()] = v if ret == 0 or v == 0 else ret
+            if r != first:
+                r.copied(output, rets[r.index()], first.run_time())
+
+    async def run(self, output):
+        rets = {}
+        try:
+            targets = self._remotes
+            holders = []
+            if self._args.checksum:
+                self._sha256 = self._local_sha256()
+                sums = await asyncio.gather(*[ self._remote_sha256(r) for r in self._remotes ])
+                holders = [ r for r, s in zip(self._remotes, sums) if s == self._sha256 ]
+                for r in holders:
+                    print(colorama.Fore.GREEN + f'Host {r.host()} is up to date')
+                    rets[r.index()] = 0
+                targets = [ r for r in self._remotes if r not in holders ]
+            if len(targets) > 0:
+                if self._args.copy_mode == 'chain':
+                    await self._chain(targets, rets, output)
+                else:
+                    await self._tree(targets, holders if self._args.copy_mode == 'tree' else [], rets, output)
+        finally:
+            output.close()
+        return [ rets[r.index()] for r in self._remotes ]
+
+def show_timing(remotes, rets, groups = None):
+    width = max([ len(r.host()) for r in remotes ] + [ 4 ])
+    print(f'{"host":<{width}} {"exit":>5} {"tries":>5} {"connect":>8} {"run":>8}' + (f' {"group":>5}' if groups is not None else ''))
+    for r, ret in zip(remotes, rets):
+        conn = f'{r.connect_time():.2f}' if r.connect_time() is not None else '-'
+        grp = f' {groups.group(r) or "-":>5}' if groups is not None else ''
+        print(f'{r.host():<{width}} {ret:>5} {r.attempts():>5} {conn:>8} {r.run_time():>8.2f}' + grp)
 
 remotes = []
 user_and_hosts = args.hosts.split('@', 2)
@@ -74,11 +542,21 @@ user = user_and_hosts[0] if len(user_and_hosts) == 2 else None
 hosts = user_and_hosts[-1]
 
 for h in hosts.split(':'):
-    remotes.append(remote(user, h, args))
-
-for r in remotes:
-    r.start()
-for r in remotes:
-    r.join()
-for r in remotes:
-    r.report()
+    remotes.append(remote(user, h, len(remotes), args))
+
+if args.output_dir is not None:
+    output = file_output(remotes, args.output_dir)
+elif args.aggregate:
+    output = aggregate_output(remotes)
+else:
+    output = stream_output(remotes)
+
+if args.command[0] == '--copy' and (args.copy_mode != 'direct' or args.compress != 'none' or args.checksum):
+    rets = asyncio.run(distributor(remotes, args).run(output))
+else:
+    rets = asyncio.run(run_all(remotes, output, args.jobs))
+if args.aggregate and args.output_dir is None:
+    show_timing(remotes, rets, output)
+elif args.timing:
+    show_timing(remotes, rets)
+sys.exit(0 if all([ ret == 0 for ret in rets ]) else 1)
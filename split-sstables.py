@@ -1,45 +1,354 @@
 #!/bin/env python3
 
+import os
+import sys
+import json
+import mmap
+import time
+import resource
+import tempfile
+import contextlib
+import subprocess
+import heapq
+import array
+import bisect
+import itertools
+import collections
 import random
+import argparse
+import multiprocessing
 
-nr_nodes = 5                                    # Number of nodes in the cluster
-nr_tablets = 8                                  # Number of tablets in a map
-nr_records = 37 * 1024                          # Total number of records inserted
-max_pkey = 2048                                 # Maximum partition key value (minimum is 0)
-node_memtable_size = random.randint(500, 600)   # Maximum number of records in a memtable/sstable
-partition_size = random.randint(1, 16)          # Maximum number of rows in a partition
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-class partition:
-    def __init__(self, pkey):
-        self._pkey = pkey
-        self._rows = {}
+parser = argparse.ArgumentParser(description='Tablets split simulator')
+parser.add_argument('-n', dest='nodes', type=int, default=5, help='Number of nodes in the cluster (default 5)')
+parser.add_argument('-t', dest='tablets', type=int, default=8, help='Number of tablets in a map (default 8)')
+parser.add_argument('-r', dest='records', type=int, default=37 * 1024, help='Total number of records inserted (default 37888)')
+parser.add_argument('-k', dest='max_pkey', type=int, default=2048, help='Maximum partition key value (default 2048)')
+parser.add_argument('--memtable-size', dest='memtable_size', type=int, default=None, help='Maximum number of rows in a memtable (default random 500-600)')
+parser.add_argument('--partition-size', dest='partition_size', type=int, default=None, help='Maximum number of rows in a partition (default random 1-16)')
+parser.add_argument('-d', dest='distribution', choices=['uniform', 'zipfian', 'hot'], default='uniform', help='Partition keys distribution (default uniform)')
+parser.add_argument('-B', dest='batch', type=int, default=64 * 1024, help='Records generated and routed at once (default 65536)')
+parser.add_argument('-j', dest='jobs', type=int, default=1, help='Number of processes to simulate nodes in (default 1)')
+parser.add_argument('-c', dest='compaction', choices=['none', 'stcs', 'ics'], default='none', help='Compaction strategy nodes run after flushes (default none)')
+parser.add_argument('--fragment-size', dest='fragment_size', type=int, default=0, help='Rows in an ics sstable run fragment (default memtable size)')
+parser.add_argument('-m', dest='maps', action='append', help='Target tablet map to estimate rewrite cost for (split, buckets, uniform:$nr_tablets or $key,$key,...), default split')
+parser.add_argument('--row-size', dest='row_size', type=int, default=1024, help='Row size in bytes for rewrite cost (default 1024)')
+parser.add_argument('--reads', type=int, default=1000, help='Number of reads to simulate against each layout (default 1000, 0 to skip)')
+parser.add_argument('--scan-fraction', dest='scan_fraction', type=float, default=0.1, help='Share of reads that are range scans (default 0.1)')
+parser.add_argument('--scan-width', dest='scan_width', type=int, default=16, help='Number of keys a range scan spans (default 16)')
+parser.add_argument('--bloom-fp', dest='bloom_fp', type=float, default=0.01, help='Bloom filter false-positive rate (default 0.01)')
+parser.add_argument('--sstable-dir', dest='sstable_dir', default=None, help='Keep flushed sstables in files in this directory instead of memory')
+parser.add_argument('--seed', type=int, default=None, help='Random seed (default is random, printed at start)')
+parser.add_argument('-q', dest='quiet', action='store_true', help='Don\'t list tablets, sstables and buckets')
+parser.add_argument('--timing', default=None, help='Write phases timing and peak RSS as JSON into this file')
+parser.add_argument('--bench', action='append', help='Benchmark over a grid of $param=$value,$value,... (can be repeated), see bench_knobs')
+parser.add_argument('--bench-out', dest='bench_out', default=None, help='File to write benchmark JSON results to (default stdout)')
+args = parser.parse_args()
+
+# Files keep clustering keys as 64-bit masks
+if args.sstable_dir is not None and args.partition_size is not None and args.partition_size >= 64:
+    parser.error('--partition-size must be below 64 with --sstable-dir')
+
+if args.seed is None:
+    args.seed = random.randrange(1 << 32)
+random.seed(args.seed)
+
+nr_nodes = args.nodes                           # Number of nodes in the cluster
+nr_tablets = args.tablets                       # Number of tablets in a map
+nr_records = args.records                       # Total number of records inserted
+max_pkey = args.max_pkey                        # Maximum partition key value (minimum is 0)
+node_memtable_size = args.memtable_size or random.randint(500, 600)   # Maximum number of records in a memtable/sstable
+partition_size = args.partition_size or random.randint(1, 16)         # Maximum number of rows in a partition
+
+assert nr_tablets < max_pkey, "Too many tablets for the keys range"
+
+# Partitions are stored as pkey -> bitmask of clustering keys present in
+# it, so a row is a single bit and the number of rows is the popcount.
+def partition_rows(ckeys):
+    return ckeys.bit_count()
+
+
+# Sorted partition keys and running sum of rows in front of each of them
+def make_index(partitions):
+    keys = sorted(partitions)
+    rows = itertools.accumulate([ partition_rows(partitions[k]) for k in keys ], initial = 0)
+    return (array.array('q', keys), array.array('q', rows))
+
+
+# Number of partitions and rows with keys in (lo, hi], lo of None means
+# from the very beginning
+def count_range(index, lo, hi):
+    keys, rows = index
+    i = 0 if lo is None else bisect.bisect_right(keys, lo)
+    j = bisect.bisect_right(keys, hi)
+    if j <= i:
+        return (0, 0)
+    return (j - i, rows[j] - rows[i])
+
+
+# On-disk sstable: number of partitions, sorted keys, running sum of rows
+# and clustering keys masks, all as native 64-bit integers. The file is
+# mmap-ed on demand and at most max_open files are kept mapped at a time
+# (each mapping holds a file descriptor).
+class sstable_file:
+    max_open = 512
+    _mapped = collections.OrderedDict()     # path -> sstable_file
+
+    def __init__(self, path):
+        self._path = path
+        self._map = None
+        self._views = None
+
+    @staticmethod
+    def write(path, partitions):
+        keys = sorted(partitions)
+        masks = [ partitions[k] for k in keys ]
+        assert max(masks).bit_length() <= 64, "Clustering keys don't fit 64-bit masks"
+        rows = itertools.accumulate([ partition_rows(m) for m in masks ], initial = 0)
+        with open(path, 'wb') as f:
+            array.array('q', [len(keys)]).tofile(f)
+            array.array('q', keys).tofile(f)
+            array.array('q', rows).tofile(f)
+            array.array('Q', masks).tofile(f)
+        return sstable_file(path)
+
+    def _mapping(self):
+        if self._map is not None:
+            sstable_file._mapped.move_to_end(self._path)
+            return self._views
+
+        with open(self._path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        mv = memoryview(self._map)
+        n = mv[:8].cast('q')[0]
+        keys = mv[8 : 8 * (n + 1)].cast('q')
+        rows = mv[8 * (n + 1) : 8 * (2 * n + 2)].cast('q')
+        masks = mv[8 * (2 * n + 2) : 8 * (3 * n + 2)].cast('Q')
+        self._views = (keys, rows, masks, mv)
+
+        sstable_file._mapped[self._path] = self
+        if len(sstable_file._mapped) > sstable_file.max_open:
+            sstable_file._mapped.popitem(last = False)[1]._unmap()
+        return self._views
+
+    def _unmap(self):
+        for v in self._views:
+            v.release()
+        self._map.close()
+        self._map = None
+        self._views = None
+
+    def index(self):
+        v = self._mapping()
+        return (v[0], v[1])
+
+    def partitions(self):
+        v = self._mapping()
+        return dict(zip(v[0], v[2]))
+
+    # Copies out a chunk at a time and re-maps for every chunk, as the
+    # file can be unmapped by others while the iteration is suspended
+    def masks(self, chunk = 4096):
+        n = len(self._mapping()[0])
+        for lo in range(0, n, chunk):
+            keys, rows, masks, mv = self._mapping()
+            yield from zip(keys[lo : lo + chunk].tolist(), masks[lo : lo + chunk].tolist())
+
+    def remove(self):
+        if self._map is not None:
+            del sstable_file._mapped[self._path]
+            self._unmap()
+        os.unlink(self._path)
+
+    # Only the path travels between processes, the file is re-mapped there
+    def __getstate__(self):
+        return { '_path': self._path }
+
+    def __setstate__(self, state):
+        self.__init__(state['_path'])
+
+
+# Writes an sstable file partition by partition. Keys go right after the
+# header, rows and masks sections are spilled to temporary files and
+# appended when done, so memory use doesn't depend on the sstable size.
+class sstable_writer:
+    chunk = 4096
 
-    def mutate_row(self, ckey):
-        if ckey not in self._rows:
-            self._rows[ckey] = 0
-        self._rows[ckey] += 1
+    def __init__(self, path):
+        self._path = path
+        self._f = open(path, 'wb')
+        array.array('q', [0]).tofile(self._f)
+        self._rows_f = tempfile.TemporaryFile()
+        self._masks_f = tempfile.TemporaryFile()
+        self._keys = array.array('q')
+        self._rows = array.array('q', [0])
+        self._masks = array.array('Q')
+        self._n = 0
+        self._total = 0
 
-    def rows(self):
-        return len(self._rows)
+    def _spill(self):
+        self._keys.tofile(self._f)
+        self._rows.tofile(self._rows_f)
+        self._masks.tofile(self._masks_f)
+        self._keys = array.array('q')
+        self._rows = array.array('q')
+        self._masks = array.array('Q')
+
+    def add(self, pkey, ckeys):
+        self._total += partition_rows(ckeys)
+        self._keys.append(pkey)
+        self._rows.append(self._total)
+        self._masks.append(ckeys)
+        self._n += 1
+        if len(self._keys) >= sstable_writer.chunk:
+            self._spill()
+
+    def close(self):
+        self._spill()
+        for t in (self._rows_f, self._masks_f):
+            t.seek(0)
+            while True:
+                buf = t.read(1024 * 1024)
+                if not buf:
+                    break
+                self._f.write(buf)
+            t.close()
+        self._f.seek(0)
+        array.array('q', [self._n]).tofile(self._f)
+        self._f.close()
+        return sstable_file(self._path)
 
 
 class sstable:
     sstable_id = 0
 
-    def __init__(self, partitions, origin):
+    def __init__(self, partitions, origin, nr_rows = None):
         self._id = sstable.sstable_id
         sstable.sstable_id += 1
         self._partitions = partitions
+        self._nr_partitions = len(partitions) if partitions is not None else 0
         self._origin = origin
+        self._range = None
+        self._nr_rows = nr_rows
+        self._index = None
+        self._file = None
+
+    # Builds an sstable from (pkey, ckeys) pairs coming in key order, right
+    # into a file when the directory is given
+    @staticmethod
+    def build(items, origin, directory = None):
+        if directory is None:
+            parts = dict(items)
+            return sstable(parts, origin) if len(parts) > 0 else None
+        sst = sstable(None, origin)
+        w = sstable_writer(sst._path(directory))
+        first = last = None
+        for pkey, ckeys in items:
+            if first is None:
+                first = pkey
+            last = pkey
+            w.add(pkey, ckeys)
+        sst._file = w.close()
+        if first is None:
+            sst.remove()
+            return None
+        sst._range = (first, last)
+        sst._nr_partitions = w._n
+        sst._nr_rows = w._total
+        return sst
+
+    def _path(self, directory):
+        return os.path.join(directory, f'{self._origin}-{self._id}.sst')
+
+    # Moves partitions into a file, only metadata stays in memory
+    def store(self, directory):
+        self.key_range()
+        self.nr_rows()
+        self._file = sstable_file.write(self._path(directory), self._partitions)
+        self._partitions = None
+        self._index = None
+
+    def remove(self):
+        if self._file is not None:
+            self._file.remove()
+
+    def file(self):
+        return self._file
 
     def key_range(self):
-        return (min(self._partitions), max(self._partitions))
+        if self._range is None:
+            self._range = (min(self._partitions), max(self._partitions))
+        return self._range
 
     def nr_partitions(self):
-        return len(self._partitions)
+        return self._nr_partitions
+
+    def nr_rows(self):
+        if self._nr_rows is None:
+            self._nr_rows = sum([ partition_rows(p) for p in self._partitions.values() ])
+        return self._nr_rows
+
+    def index(self):
+        if self._file is not None:
+            return self._file.index()
+        if self._index is None:
+            self._index = make_index(self._partitions)
+        return self._index
+
+    def partitions(self):
+        if self._file is not None:
+            return self._file.partitions()
+        return self._partitions
+
+    # (pkey, ckeys) pairs in pkey order
+    def masks(self):
+        if self._file is not None:
+            return self._file.masks()
+        return iter(sorted(self._partitions.items()))
+
+    def count_range(self, lo, hi):
+        return count_range(self.index(), lo, hi)
+
+    def origin(self):
+        return self._origin
+
+    def id(self):
+        return self._id
+
+
+# What is left of an sstable when it's passed between processes: the
+# metadata the splitter and the rewrite planner need, without the
+# partitions themselves
+class sstable_summary:
+    def __init__(self, sst):
+        self._id = sst.id()
+        self._origin = sst.origin()
+        self._range = sst.key_range()
+        self._nr_partitions = sst.nr_partitions()
+        self._nr_rows = sst.nr_rows()
+        self._file = sst.file()
+        self._index = sst.index() if self._file is None else None
+
+    def index(self):
+        if self._file is not None:
+            return self._file.index()
+        return self._index
+
+    def count_range(self, lo, hi):
+        return count_range(self.index(), lo, hi)
+
+    def key_range(self):
+        return self._range
+
+    def nr_partitions(self):
+        return self._nr_partitions
 
     def nr_rows(self):
-        return sum([ p.rows() for p in self._partitions.values() ])
+        return self._nr_rows
 
     def origin(self):
         return self._origin
@@ -47,62 +356,277 @@ class sstable:
     def id(self):
         return self._id
 
+    def set_id(self, sid):
+        self._id = sid
+
 
 class memtable:
     def __init__(self, origin):
         self._partitions = {}
+        self._rows = 0
         self._origin = origin
 
     def empty(self):
         return len(self._partitions) == 0
 
     def flush(self):
-        part = self._partitions
+        sst = sstable(self._partitions, self._origin, self._rows)
         self._partitions = {}
-        return sstable(part, self._origin)
+        self._rows = 0
+        return sst
 
     def mutate(self, pkey, ckey):
-        if pkey not in self._partitions:
-            self._partitions[pkey] = partition(pkey)
-        self._partitions[pkey].mutate_row(ckey)
+        old = self._partitions.get(pkey, 0)
+        new = old | (1 << ckey)
+        if new != old:
+            self._partitions[pkey] = new
+            self._rows += 1
+
+    # Applies mutations starting from pos until the memtable reaches limit
+    # rows or the input is exhausted, returns the position it stopped at
+    def mutate_many(self, pkeys, ckeys, pos, limit):
+        parts = self._partitions
+        rows = self._rows
+        end = len(pkeys)
+        while pos < end and rows < limit:
+            pkey = pkeys[pos]
+            old = parts.get(pkey, 0)
+            new = old | (1 << ckeys[pos])
+            if new != old:
+                parts[pkey] = new
+                rows += 1
+            pos += 1
+        self._rows = rows
+        return pos
 
     def size(self):
-        return sum([ p.rows() for p in self._partitions.values() ])
+        return self._rows
+
+    def nr_partitions(self):
+        return len(self._partitions)
+
+
+# (pkey, ckeys) pairs of the sstables merged together, in key order. The
+# sstables are walked side by side, so nothing but the current partition
+# is kept in memory
+def merge_partitions(sstables):
+    key, ckeys = None, 0
+    for pkey, m in heapq.merge(*[ s.masks() for s in sstables ], key = lambda x : x[0]):
+        if pkey != key:
+            if key is not None:
+                yield (key, ckeys)
+            key, ckeys = pkey, 0
+        ckeys |= m
+    if key is not None:
+        yield (key, ckeys)
+
+
+# Rows left after merging
+def live_rows(sstables):
+    return sum([ partition_rows(ckeys) for pkey, ckeys in merge_partitions(sstables) ])
+
+
+# Sstables are grouped into runs (lists of sstables with disjoint ranges),
+# a strategy picks runs of a tablet to compact together and decides how
+# the result is laid out
+class no_compaction:
+    def select(self, runs):
+        return None
+
+
+class size_tiered:
+    min_threshold = 4
+    max_threshold = 32
+    bucket_low = 0.5
+    bucket_high = 1.5
+
+    def _buckets(self, runs):
+        buckets = []
+        avg = 0
+        for r in sorted(runs, key = lambda r : run_rows(r)):
+            sz = run_rows(r)
+            if len(buckets) > 0 and avg * size_tiered.bucket_low <= sz <= avg * size_tiered.bucket_high:
+                buckets[-1].append(r)
+                avg += (sz - avg) / len(buckets[-1])
+            else:
+                buckets.append([r])
+                avg = sz
+        return buckets
+
+    def select(self, runs):
+        candidates = [ b for b in self._buckets(runs) if len(b) >= size_tiered.min_threshold ]
+        if len(candidates) == 0:
+            return None
+        b = max(candidates, key = lambda b : len(b))
+        return b[:size_tiered.max_threshold]
+
+    def output(self, parts, origin, directory):
+        sst = sstable.build(parts, origin, directory)
+        return [ sst ] if sst is not None else []
+
+    # Rows occupying disk in addition to inputs while compaction runs
+    def overhead(self, rows):
+        return rows
+
+
+# Same tiering as stcs, but the output run is made of fixed size fragments
+# and inputs are released as fragments are written, so the temporary space
+# needed is about one fragment
+class incremental(size_tiered):
+    def __init__(self, fragment_rows):
+        self._fragment_rows = fragment_rows
+
+    # Fragments end after the partition that brings them to fragment_rows
+    def _fragment(self, parts, first):
+        yield first
+        rows = partition_rows(first[1])
+        while rows < self._fragment_rows:
+            p = next(parts, None)
+            if p is None:
+                return
+            rows += partition_rows(p[1])
+            yield p
+
+    def output(self, parts, origin, directory):
+        run = []
+        while True:
+            first = next(parts, None)
+            if first is None:
+                break
+            run.append(sstable.build(self._fragment(parts, first), origin, directory))
+        return run
+
+    def overhead(self, rows):
+        return min(rows, self._fragment_rows)
+
+
+def run_rows(run):
+    return sum([ s.nr_rows() for s in run ])
+
+
+class compaction_stats:
+    def __init__(self):
+        self.compactions = 0
+        self.flushed_rows = 0
+        self.written_rows = 0           # By compactions only
+        self.disk_rows = 0
+        self.peak_disk_rows = 0
+        self.live_rows = 0              # What's left after everything is compacted together
+        self.history = []               # Number of sstables after each flush
+
+    def write_amplification(self):
+        return (self.flushed_rows + self.written_rows) / self.flushed_rows if self.flushed_rows > 0 else 0.0
+
+    def space_amplification(self):
+        return self.peak_disk_rows / self.live_rows if self.live_rows > 0 else 0.0
+
+    def format(self):
+        h = self.history
+        step = max(1, len(h) // 16)
+        return (f'{self.compactions} compactions, write amp {self.write_amplification():.2f}, space amp {self.space_amplification():.2f}, ' +
+                f'sstables max {max(h, default = 0)} over time {h[::step]}')
 
 
 class node:
     node_id = 0
 
-    def __init__(self, max_memtable_size: int):
+    def __init__(self, max_memtable_size: int, seed = None, strategy = None, store = None):
         self._memtables = {}
-        self._sstables = []
+        self._thresholds = {}   # tablet id -> size at which its memtable is flushed
+        self._runs = {}         # tablet id -> list of sstable runs
+        self._strategy = strategy or no_compaction()
+        self._stats = compaction_stats()
+        self._store = store     # Directory to keep sstables in, None for memory
         self._memtable_size = max_memtable_size
         self._id = node.node_id
         node.node_id += 1
+        # Each node draws from its own generator so that its flushes don't
+        # depend on what other nodes do or on which process runs it
+        self._random = random.Random(f'{seed}:{self._id}')
 
-    def mutate(self, tid, pkey, ckey):
+    def _threshold(self):
+        return self._random.randint(int(self._memtable_size * 0.90), self._memtable_size)
+
+    def _memtable(self, tid):
         if tid not in self._memtables:
             self._memtables[tid] = memtable(self._id)
-        mt = self._memtables[tid]
+            self._thresholds[tid] = self._threshold()
+        return self._memtables[tid]
+
+    def mutate(self, tid, pkey, ckey):
+        mt = self._memtable(tid)
         mt.mutate(pkey, ckey)
-        threshold = random.randint(int(self._memtable_size * 0.90), self._memtable_size)
-        if mt.size() >= threshold:
-            self._flush(mt)
+        if mt.size() >= self._thresholds[tid]:
+            self._flush(tid)
 
-    def _flush(self, mt: memtable):
-        self._sstables.append(mt.flush())
+    def mutate_many(self, tid, pkeys, ckeys):
+        mt = self._memtable(tid)
+        pos = 0
+        while pos < len(pkeys):
+            pos = mt.mutate_many(pkeys, ckeys, pos, self._thresholds[tid])
+            if mt.size() >= self._thresholds[tid]:
+                self._flush(tid)
+
+    def _flush(self, tid):
+        sst = self._memtables[tid].flush()
+        self._thresholds[tid] = self._threshold()
+        if self._store is not None:
+            sst.store(self._store)
+        if tid not in self._runs:
+            self._runs[tid] = []
+        self._runs[tid].append([sst])
+        self._stats.flushed_rows += sst.nr_rows()
+        self._stats.disk_rows += sst.nr_rows()
+        self._stats.peak_disk_rows = max(self._stats.peak_disk_rows, self._stats.disk_rows)
+        self._compact(tid)
+        self._stats.history.append(sum([ len(r) for runs in self._runs.values() for r in runs ]))
+
+    def _compact(self, tid):
+        runs = self._runs[tid]
+        while True:
+            inputs = self._strategy.select(runs)
+            if inputs is None:
+                break
+            out = self._strategy.output(merge_partitions([ s for r in inputs for s in r ]), self._id, self._store)
+            if self._store is not None:
+                for s in [ s for r in inputs for s in r ]:
+                    s.remove()
+            in_rows = sum([ run_rows(r) for r in inputs ])
+            out_rows = run_rows(out)
+            st = self._stats
+            st.compactions += 1
+            st.written_rows += out_rows
+            st.peak_disk_rows = max(st.peak_disk_rows, st.disk_rows + self._strategy.overhead(out_rows))
+            st.disk_rows += out_rows - in_rows
+            runs = [ r for r in runs if not any(r is i for i in inputs) ] + [out]
+        self._runs[tid] = runs
 
     def flush(self):
         for tid in self._memtables:
-            mt = self._memtables[tid]
-            if not mt.empty():
-                self._flush(mt)
+            if not self._memtables[tid].empty():
+                self._flush(tid)
 
     def id(self):
         return self._id
 
     def sstables(self):
-        return self._sstables
+        return [ s for runs in self._runs.values() for r in runs for s in r ]
+
+    def stats(self):
+        if self._stats.live_rows == 0:
+            for runs in self._runs.values():
+                self._stats.live_rows += live_rows([ s for r in runs for s in r ])
+        return self._stats
+
+    def summaries(self):
+        return { tid: [ [ sstable_summary(s) for s in r ] for r in runs ] for tid, runs in self._runs.items() }
+
+    def adopt(self, runs, stats):
+        self._memtables = {}
+        self._thresholds = {}
+        self._runs = runs
+        if stats is not None:
+            self._stats = stats
 
 
 class tablet:
@@ -133,30 +657,104 @@ class tablet:
         for r in self._replicas:
             r.mutate(self._id, pkey, ckey)
 
+    def mutate_many(self, pkeys, ckeys, nodes = None):
+        for r in self._replicas:
+            if nodes is None or r.id() in nodes:
+                r.mutate_many(self._id, pkeys, ckeys)
+
+
+class tablet_map:
+    def __init__(self):
+        self._keys = []         # Sorted tablets' last keys
+        self._tablets = []      # Tablets, in the same order as _keys
+
+    def add(self, t):
+        i = bisect.bisect_left(self._keys, t.pkey())
+        self._keys.insert(i, t.pkey())
+        self._tablets.insert(i, t)
+
+    def add_many(self, tablets):
+        self._tablets += tablets
+        self._tablets.sort(key = lambda t : t.pkey())
+        self._keys = [ t.pkey() for t in self._tablets ]
+
+    def find(self, pkey):
+        i = bisect.bisect_left(self._keys, pkey)
+        assert i < len(self._keys), f"Cannot find tablet for {pkey}"
+        return self._tablets[i]
+
+    # Groups records by the tablet owning them, yields (tablet, pkeys, ckeys)
+    # with records order preserved within each tablet
+    def route(self, pkeys, ckeys):
+        if np is not None:
+            pk = np.asarray(pkeys)
+            ck = np.asarray(ckeys)
+            idx = np.searchsorted(self._keys, pk, side='left')
+            assert len(idx) == 0 or idx.max() < len(self._keys), f"Cannot find tablet for {pk.max()}"
+            order = np.argsort(idx, kind='stable')
+            idx = idx[order]
+            pk = pk[order]
+            ck = ck[order]
+            tids, starts = np.unique(idx, return_index=True)
+            ends = list(starts[1:]) + [len(idx)]
+            for i, lo, hi in zip(tids, starts, ends):
+                yield (self._tablets[i], pk[lo:hi].tolist(), ck[lo:hi].tolist())
+        else:
+            groups = {}
+            for pkey, ckey in zip(pkeys, ckeys):
+                i = bisect.bisect_left(self._keys, pkey)
+                assert i < len(self._keys), f"Cannot find tablet for {pkey}"
+                if i not in groups:
+                    groups[i] = ([], [])
+                groups[i][0].append(pkey)
+                groups[i][1].append(ckey)
+            for i in sorted(groups):
+                yield (self._tablets[i], groups[i][0], groups[i][1])
+
+    def keys(self):
+        return self._keys
+
+    def __iter__(self):
+        return iter(self._tablets)
+
+    def __len__(self):
+        return len(self._tablets)
+
 
 class cluster:
-    def __init__(self, memtable_size, rf = 3):
+    def __init__(self, memtable_size, rf = 3, seed = None, strategy = None, store = None):
         self._nodes = []
-        self._tablets = []
+        self._tablets = tablet_map()
+        self._replicas = {}     # node id -> number of tablet replicas on it
+        self._placement = []    # heap of (replicas, node id, node)
         self._node_memtable_size = memtable_size
         self._rf = rf
+        self._seed = seed
+        self._strategy = strategy
+        self._store = store
 
     def count_tablet_replicas(self, n):
-        ret = 0
-        for t in self._tablets:
-            if t.has(n):
-                ret += 1
-        return ret
+        return self._replicas[n.id()]
 
-    def add_tablet(self, pkey):
+    def _place_tablet(self, pkey):
         assert len(self._nodes) >= self._rf, "Not enough nodes to add tablets"
-        self._nodes.sort(key = lambda r: self.count_tablet_replicas(r))
-        t = tablet(pkey, self._nodes[:self._rf])
-        self._tablets.append(t)
-        self._tablets.sort(key = lambda t : t.pkey())
+        replicas = [ heapq.heappop(self._placement) for i in range(self._rf) ]
+        for nr, nid, n in replicas:
+            self._replicas[nid] = nr + 1
+            heapq.heappush(self._placement, (nr + 1, nid, n))
+        return tablet(pkey, [ r[2] for r in replicas ])
+
+    def add_tablet(self, pkey):
+        self._tablets.add(self._place_tablet(pkey))
+
+    def add_tablets(self, pkeys):
+        self._tablets.add_many([ self._place_tablet(pkey) for pkey in pkeys ])
 
     def add_node(self):
-        self._nodes.append(node(self._node_memtable_size))
+        n = node(self._node_memtable_size, self._seed, self._strategy, self._store)
+        self._nodes.append(n)
+        self._replicas[n.id()] = 0
+        heapq.heappush(self._placement, (0, n.id(), n))
 
     def tablet_map(self):
         tmap = {}
@@ -165,19 +763,21 @@ class cluster:
         return tmap
 
     def find_tablet(self, pkey):
-        for t in self._tablets:
-            if pkey <= t.pkey():
-                return t
-
-        assert False, f"Cannot find tablet for {pkey}"
+        return self._tablets.find(pkey)
 
     def mutate(self, pkey, ckey):
         t = self.find_tablet(pkey)
         t.mutate(pkey, ckey)
 
-    def flush(self):
+    # When nodes (a set of node ids) is given, only these replicas are updated
+    def mutate_many(self, pkeys, ckeys, nodes = None):
+        for t, pk, ck in self._tablets.route(pkeys, ckeys):
+            t.mutate_many(pk, ck, nodes)
+
+    def flush(self, nodes = None):
         for n in self._nodes:
-            n.flush()
+            if nodes is None or n.id() in nodes:
+                n.flush()
 
     def collect_sstables(self):
         ret = []
@@ -188,64 +788,544 @@ class cluster:
     def nodes(self):
         return self._nodes
 
+    def node(self, nid):
+        for n in self._nodes:
+            if n.id() == nid:
+                return n
+        assert False, f"Cannot find node {nid}"
 
-def pop_overlapping_head(sstables):
-    sst = sstables.pop(0)
-    rng = sst.key_range()
-    ssts = [sst]
-    while len(sstables) > 0:
-        r = sstables[0].key_range()
-        if r[0] < rng[1]:
-            ssts.append(sstables.pop(0))
-            rng = (rng[0], max(rng[1], r[1]))
+
+class workload:
+    zipf_exponent = 0.99
+    hot_fraction = 0.9          # Share of records hitting the hot range
+    hot_width = 0.1             # Share of the key space the hot range spans
+
+    def __init__(self, dist, max_pkey, partition_size, seed = None):
+        self._dist = dist
+        self._max_pkey = max_pkey
+        self._partition_size = partition_size
+        self._random = random.Random(seed)
+        self._rng = np.random.default_rng(self._random.getrandbits(64)) if np is not None else None
+
+        if dist == 'zipfian':
+            # Key popularity ranks are shuffled over the key space so that
+            # hot keys don't all land into the first tablet
+            keys = list(range(max_pkey + 1))
+            self._random.shuffle(keys)
+            weights = [ 1.0 / (r + 1) ** workload.zipf_exponent for r in range(max_pkey + 1) ]
+            if np is not None:
+                self._keys = np.array(keys)
+                self._cdf = np.cumsum(weights)
+            else:
+                self._keys = keys
+                self._cdf = [0.0] * len(weights)
+                acc = 0.0
+                for i, w in enumerate(weights):
+                    acc += w
+                    self._cdf[i] = acc
+
+        if dist == 'hot':
+            width = max(1, int((max_pkey + 1) * workload.hot_width))
+            self._hot_lo = self._random.randint(0, max_pkey + 1 - width)
+            self._hot_hi = self._hot_lo + width - 1
+
+    def _generate_np(self, n):
+        rng = self._rng
+        if self._dist == 'uniform':
+            pkeys = rng.integers(0, self._max_pkey + 1, n)
+        elif self._dist == 'zipfian':
+            idx = np.searchsorted(self._cdf, rng.random(n) * self._cdf[-1], side='right')
+            pkeys = self._keys[np.minimum(idx, len(self._keys) - 1)]
         else:
-            break
-    return (rng, ssts)
+            hot = rng.random(n) < workload.hot_fraction
+            pkeys = np.where(hot, rng.integers(self._hot_lo, self._hot_hi + 1, n), rng.integers(0, self._max_pkey + 1, n))
+        ckeys = rng.integers(0, self._partition_size + 1, n)
+        return (pkeys, ckeys)
+
+    def _pkey(self):
+        rnd = self._random
+        if self._dist == 'uniform':
+            return rnd.randint(0, self._max_pkey)
+        if self._dist == 'zipfian':
+            return rnd.choices(self._keys, cum_weights=self._cdf)[0]
+        if rnd.random() < workload.hot_fraction:
+            return rnd.randint(self._hot_lo, self._hot_hi)
+        return rnd.randint(0, self._max_pkey)
+
+    def generate(self, n):
+        if np is not None:
+            return self._generate_np(n)
+        pkeys = [ self._pkey() for i in range(n) ]
+        ckeys = [ self._random.randint(0, self._partition_size) for i in range(n) ]
+        return (pkeys, ckeys)
+
+
+def fill(cl, wl, nr_records, batch, nodes = None):
+    for done in range(0, nr_records, batch):
+        pkeys, ckeys = wl.generate(min(batch, nr_records - done))
+        cl.mutate_many(pkeys, ckeys, nodes)
+
+
+# Runs in a forked worker that inherits the populated cluster and a fresh
+# copy of the workload, so every worker sees the very same records stream
+# and only applies the part of it that its nodes are replicas for
+def fill_worker(node_ids):
+    nodes = set(node_ids)
+    fill(cl, wl, nr_records, args.batch, nodes)
+    start = time.perf_counter()
+    cl.flush(nodes)
+    flush_time = time.perf_counter() - start
+    # Stats are only shown with compaction, live rows are not worth counting otherwise
+    return ([ (nid, cl.node(nid).summaries(), cl.node(nid).stats() if args.compaction != 'none' else None) for nid in node_ids ], flush_time)
+
+
+# Returns the time the slowest worker spent flushing
+def fill_parallel(cl, jobs):
+    shards = [ [ n.id() for n in cl.nodes()[i::jobs] ] for i in range(jobs) ]
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        results = pool.map(fill_worker, shards)
+
+    # sstable ids are allocated independently in each worker, renumber them
+    for nid, runs, stats in sorted([ r for res in results for r in res[0] ], key = lambda x : x[0]):
+        for s in [ s for rs in runs.values() for r in rs for s in r ]:
+            s.set_id(sstable.sstable_id)
+            sstable.sstable_id += 1
+        cl.node(nid).adopt(runs, stats)
+    return max([ res[1] for res in results ])
 
 
 def split_sstables_into_buckets(sstables):
-    sstables.sort(key = lambda s : s.key_range()[0])
-    ranges = []
-    while len(sstables) > 0:
-        ranges.append(pop_overlapping_head(sstables))
-    return ranges
+    ssts = sorted([ (s.key_range(), s) for s in sstables ], key = lambda x : x[0][0])
+    rng = None
+    bucket = []
+    for r, s in ssts:
+        if len(bucket) > 0 and r[0] < rng[1]:
+            bucket.append(s)
+            rng = (rng[0], max(rng[1], r[1]))
+        else:
+            if len(bucket) > 0:
+                yield (rng, bucket)
+            rng = r
+            bucket = [s]
+    if len(bucket) > 0:
+        yield (rng, bucket)
+
+
+class bucket_stats:
+    def __init__(self):
+        self._nr_buckets = 0
+        self._max_width = 0             # Maximum number of sstables in a bucket
+        self._max_span = 0              # Maximum key range covered by a bucket
+        self._partitions = []
+        self._rows = []
+
+    def track(self, buckets):
+        for b in buckets:
+            rng, ssts = b
+            self._nr_buckets += 1
+            self._max_width = max(self._max_width, len(ssts))
+            self._max_span = max(self._max_span, rng[1] - rng[0])
+            self._partitions.append(sum([ s.nr_partitions() for s in ssts ]))
+            self._rows.append(sum([ s.nr_rows() for s in ssts ]))
+            yield b
+
+    def _fmt(self, vals):
+        if len(vals) == 0:
+            return 'n/a'
+        return f'min {min(vals)} avg {sum(vals) / len(vals):.1f} max {max(vals)}'
+
+    def show(self):
+        print(f'{self._nr_buckets} buckets, max width {self._max_width} sstables, max span {self._max_span} keys')
+        print(f'\tpartitions per bucket: {self._fmt(self._partitions)}')
+        print(f'\trows per bucket:       {self._fmt(self._rows)}')
+
+
+class tablet_plan:
+    def __init__(self, lo, hi):
+        self.lo = lo                    # Exclusive, None for the first tablet
+        self.hi = hi                    # Inclusive
+        self.read = []                  # Sstables that are split to get this tablet's data
+        self.reused = []                # Sstables that fit this tablet and are kept as is
+        self.rewritten_partitions = 0
+        self.rewritten_rows = 0
+        self.reused_partitions = 0
+        self.reused_rows = 0
+
+
+# Cost of moving sstables into a new tablet map, given as the sorted list of
+# tablets' last keys. An sstable that fits into one new tablet is reused as
+# is, one that crosses a boundary is read in full and each of its pieces is
+# written into the tablet it belongs to.
+class rewrite_plan:
+    def __init__(self, name, boundaries, sstables, row_size):
+        self._name = name
+        self._keys = sorted(set(boundaries))
+        self._row_size = row_size
+        self._tablets = []
+        lo = None
+        for hi in self._keys:
+            self._tablets.append(tablet_plan(lo, hi))
+            lo = hi
+
+        self._total_rows = 0
+        self._read_rows = 0
+        self._pieces = 0
+        for s in sstables:
+            self._add(s)
+
+    def _add(self, s):
+        rng = s.key_range()
+        first = bisect.bisect_left(self._keys, rng[0])
+        last = bisect.bisect_left(self._keys, rng[1])
+        assert last < len(self._keys), f"Map {self._name} doesn't cover key {rng[1]}"
+        self._total_rows += s.nr_rows()
+
+        if first == last:
+            t = self._tablets[first]
+            t.reused.append(s)
+            t.reused_partitions += s.nr_partitions()
+            t.reused_rows += s.nr_rows()
+            return
+
+        self._read_rows += s.nr_rows()
+        for t in self._tablets[first:last+1]:
+            parts, rows = s.count_range(t.lo, t.hi)
+            if parts == 0:
+                continue
+            t.read.append(s)
+            t.rewritten_partitions += parts
+            t.rewritten_rows += rows
+            self._pieces += 1
+
+    def name(self):
+        return self._name
+
+    def read_bytes(self):
+        return self._read_rows * self._row_size
 
+    def write_bytes(self):
+        return sum([ t.rewritten_rows for t in self._tablets ]) * self._row_size
 
-print('Populating cluster')
-cl = cluster(node_memtable_size)
-for i in range(nr_nodes):
-    cl.add_node()
+    def read_amplification(self):
+        return self._read_rows / self._total_rows if self._total_rows > 0 else 0.0
 
-for t in random.sample(range(1, max_pkey-1), k=nr_tablets-1):
-    cl.add_tablet(t)
-cl.add_tablet(max_pkey)
+    def write_amplification(self):
+        return self.write_bytes() / (self._total_rows * self._row_size) if self._total_rows > 0 else 0.0
 
-print('Tablets:')
-tmap = cl.tablet_map()
-for tid in tmap:
-    print(f'\t{tid:3} -> {tmap[tid]}')
+    def show(self, verbose = True):
+        print(f'Map {self._name}: {len(self._tablets)} tablets')
+        for t in self._tablets if verbose else []:
+            print(f'\t{t.hi:6}: read {len(t.read):4} sstables, rewrite {t.rewritten_partitions:6} partitions {t.rewritten_rows:7} rows, ' +
+                  f'reuse {len(t.reused):4} sstables {t.reused_partitions:6} partitions {t.reused_rows:7} rows')
+        print(f'\tread {self.read_bytes()} bytes, write {self.write_bytes()} bytes in {self._pieces} new sstables, ' +
+              f'amplification read {self.read_amplification():.3f} write {self.write_amplification():.3f}')
 
-print('Filling cluster with records')
-for r in range(nr_records):
-    pkey = random.randint(0, max_pkey)
-    ckey = random.randint(0, partition_size)
-    cl.mutate(pkey, ckey)
 
-cl.flush()
+def candidate_map(spec, cl, buckets):
+    if spec == 'split':
+        ret = []
+        lo = -1
+        for k in cl.tablet_map():
+            if k - lo > 1:
+                ret.append(lo + (k - lo) // 2)
+            ret.append(k)
+            lo = k
+        return ret
+    if spec == 'buckets':
+        return [ b[1] for b in buckets[:-1] ] + [max_pkey]
+    if spec.startswith('uniform:'):
+        nr = int(spec.split(':')[1])
+        return [ (max_pkey + 1) * (i + 1) // nr - 1 for i in range(nr - 1) ] + [max_pkey]
+    # Like the generated maps an explicit one covers the whole key space
+    keys = sorted(set([ int(k) for k in spec.split(',') ]))
+    if keys[-1] > max_pkey:
+        parser.error(f'-m key {keys[-1]} is above the max key {max_pkey}')
+    return keys if keys[-1] == max_pkey else keys + [max_pkey]
+
+
+def compaction_strategy(name):
+    if name == 'stcs':
+        return size_tiered()
+    if name == 'ics':
+        return incremental(args.fragment_size or node_memtable_size)
+    return no_compaction()
+
+
+# Part of an sstable that falls into (lo, hi], as seen by reads once the
+# sstable is split by a tablet map. Uses the sstable's sorted key index.
+class sstable_slice:
+    def __init__(self, sst, lo, hi):
+        keys, rows = sst.index()
+        self._sst = sst
+        self._i = 0 if lo is None else bisect.bisect_right(keys, lo)
+        self._j = bisect.bisect_right(keys, hi)
+        self._range = (keys[self._i], keys[self._j - 1]) if self._i < self._j else None
+
+    def empty(self):
+        return self._range is None
+
+    def key_range(self):
+        return self._range
+
+    def id(self):
+        return self._sst.id()
+
+    def has(self, pkey):
+        keys, rows = self._sst.index()
+        k = bisect.bisect_left(keys, pkey, self._i, self._j)
+        return k < self._j and keys[k] == pkey
+
+    # Simulated bloom filter: a key the sstable doesn't have passes the
+    # filter with the given probability, decided by hashing the key with
+    # what the sstable holds, so that the answer is stable across reads
+    # and doesn't change with sstable ids, which depend on -j
+    def may_have(self, pkey, fp):
+        if self.has(pkey):
+            return True
+        return (hash((self._sst.origin(), self._sst.key_range(), self._sst.nr_rows(), pkey)) & 0xffffffff) < fp * (1 << 32)
+
+
+# How sstables of every node are laid out over a tablet map given as the
+# sorted list of tablets' last keys
+class read_layout:
+    def __init__(self, name, keys, nodes):
+        self._name = name
+        self._keys = sorted(set(keys))
+        self._slices = {}       # (node id, tablet index) -> [ sstable_slice ]
+        for n in nodes:
+            for sst in n.sstables():
+                rng = sst.key_range()
+                first = bisect.bisect_left(self._keys, rng[0])
+                last = bisect.bisect_left(self._keys, rng[1])
+                for i in range(first, last + 1):
+                    sl = sstable_slice(sst, self._keys[i - 1] if i > 0 else None, self._keys[i])
+                    if not sl.empty():
+                        self._slices.setdefault((n.id(), i), []).append(sl)
+        self._tablet_nodes = {}
+        for nid, i in self._slices:
+            self._tablet_nodes.setdefault(i, []).append(nid)
+
+    def name(self):
+        return self._name
+
+    # Number of sstables each replica touches to read pkey
+    def point_read(self, pkey, fp):
+        i = bisect.bisect_left(self._keys, pkey)
+        ret = []
+        for nid in self._tablet_nodes.get(i, []):
+            touched = 0
+            for sl in self._slices[(nid, i)]:
+                rng = sl.key_range()
+                if rng[0] <= pkey <= rng[1] and sl.may_have(pkey, fp):
+                    touched += 1
+            ret.append(touched)
+        return ret
+
+    # Number of sstables each node touches to scan keys [lo, hi]
+    def range_scan(self, lo, hi):
+        first = bisect.bisect_left(self._keys, lo)
+        last = min(bisect.bisect_left(self._keys, hi), len(self._keys) - 1)
+        touched = {}
+        for i in range(first, last + 1):
+            for nid in self._tablet_nodes.get(i, []):
+                for sl in self._slices[(nid, i)]:
+                    rng = sl.key_range()
+                    if rng[0] <= hi and lo <= rng[1]:
+                        touched[nid] = touched.get(nid, 0) + 1
+        return list(touched.values())
+
+
+def percentiles(vals, pcts = [50, 90, 99, 99.9]):
+    if len(vals) == 0:
+        return 'n/a'
+    vals = sorted(vals)
+    ret = [ f'p{p} {vals[min(len(vals) - 1, int(len(vals) * p / 100))]}' for p in pcts ]
+    return ' '.join(ret + [f'max {vals[-1]}'])
+
+
+def simulate_reads(layouts, nr_reads):
+    rnd = random.Random(f'{args.seed}:reads')
+    rwl = workload(args.distribution, max_pkey, partition_size, rnd.getrandbits(64))
+    pkeys = list(rwl.generate(nr_reads)[0])
+    scans = [ rnd.random() < args.scan_fraction for i in range(nr_reads) ]
+    print(f'Simulating {nr_reads} reads ({sum(scans)} scans of {args.scan_width} keys, bloom fp {args.bloom_fp})')
+    for l in layouts:
+        points = []
+        ranges = []
+        for pkey, scan in zip(pkeys, scans):
+            pkey = int(pkey)
+            if scan:
+                ranges += l.range_scan(pkey, pkey + args.scan_width - 1)
+            else:
+                points += l.point_read(pkey, args.bloom_fp)
+        print(f'\t{l.name()}: sstables per point read {percentiles(points)}')
+        print(f'\t{" " * len(l.name())}  sstables per range scan {percentiles(ranges)}')
+
+
+class phase_timer:
+    def __init__(self):
+        self._phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name, duration):
+        self._phases[name] = self._phases.get(name, 0.0) + duration
+
+    def phases(self):
+        return self._phases
+
+
+# Benchmark parameters and the options they are passed to simulation as
+bench_knobs = {
+    'nodes': '-n',
+    'tablets': '-t',
+    'records': '-r',
+    'max_pkey': '-k',
+    'memtable_size': '--memtable-size',
+    'partition_size': '--partition-size',
+    'distribution': '-d',
+    'batch': '-B',
+    'jobs': '-j',
+    'compaction': '-c',
+    'reads': '--reads',
+}
+
+
+def bench_base_args(argv):
+    ret = []
+    skip = False
+    for a in argv:
+        if skip:
+            skip = False
+        elif a in ('--bench', '--bench-out', '--seed', '--timing'):
+            skip = True
+        elif a.split('=')[0] not in ('--bench', '--bench-out', '--seed', '--timing'):
+            ret.append(a)
+    return ret
+
+
+# Every grid point runs in its own process, so that peak RSS is its own
+def run_benchmark():
+    grid = []
+    for b in args.bench:
+        name, vals = b.split('=', 1)
+        assert name in bench_knobs, f"Unknown benchmark parameter {name}, can be one of {', '.join(bench_knobs)}"
+        grid.append([ (name, v) for v in vals.split(',') ])
+
+    base = [ sys.executable, sys.argv[0] ] + bench_base_args(sys.argv[1:]) + ['--seed', f'{args.seed}', '-q']
+    results = []
+    for point in itertools.product(*grid):
+        cmd = list(base)
+        for name, v in point:
+            cmd += [bench_knobs[name], v]
+        with tempfile.NamedTemporaryFile(suffix = '.json') as f:
+            subprocess.run(cmd + ['--timing', f.name], stdout = subprocess.DEVNULL, check = True)
+            res = json.load(f)
+        results.append(res)
+        phases = ' '.join([ f'{p} {t:.3f}s' for p, t in res['phases'].items() ])
+        print(' '.join([ f'{n}={v}' for n, v in point ]) + f': {phases}, peak rss {res["peak_rss_kb"]} kB', file = sys.stderr)
+
+    out = open(args.bench_out, 'w') if args.bench_out is not None else sys.stdout
+    json.dump(results, out, indent = 2, sort_keys = True)
+    out.write('\n')
+
+
+def write_timing(timer, sstables, buckets):
+    res = {
+        'params': { k: v for k, v in vars(args).items() if k not in ('bench', 'bench_out', 'timing') },
+        'memtable_size': node_memtable_size,
+        'partition_size': partition_size,
+        'numpy': np is not None,
+        'phases': timer.phases(),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'sstables': len(sstables),
+        'buckets': len(buckets),
+    }
+    with open(args.timing, 'w') as f:
+        json.dump(res, f, indent = 2, sort_keys = True)
+
+
+if args.bench:
+    run_benchmark()
+    sys.exit(0)
+
+timer = phase_timer()
+
+print(f'Populating cluster (seed {args.seed})')
+with timer.phase('populate'):
+    if args.sstable_dir is not None:
+        os.makedirs(args.sstable_dir, exist_ok = True)
+    cl = cluster(node_memtable_size, seed = args.seed, strategy = compaction_strategy(args.compaction), store = args.sstable_dir)
+    for i in range(nr_nodes):
+        cl.add_node()
+
+    cl.add_tablets(random.sample(range(1, max_pkey-1), k=nr_tablets-1) + [max_pkey])
+
+if not args.quiet:
+    print('Tablets:')
+    tmap = cl.tablet_map()
+    for tid in tmap:
+        print(f'\t{tid:3} -> {tmap[tid]}')
+
+print(f'Filling cluster with {args.distribution} records')
+wl = workload(args.distribution, max_pkey, partition_size, args.seed)
+if args.jobs > 1:
+    # Workers flush too, the slowest one's flush time is reported on its own
+    # and is also a part of populate
+    with timer.phase('populate'):
+        flush_time = fill_parallel(cl, min(args.jobs, nr_nodes))
+    timer.record('flush', flush_time)
+else:
+    with timer.phase('populate'):
+        fill(cl, wl, nr_records, args.batch)
+    with timer.phase('flush'):
+        cl.flush()
 
 print('Nodes:')
 for n in cl.nodes():
     print(f'\t{n.id()}: {len(n.sstables())} sstables, replica for {cl.count_tablet_replicas(n)} tablets')
+    if args.compaction != 'none':
+        print(f'\t   {n.stats().format()}')
 
 
 print('Collecting all sstables')
-sstables = cl.collect_sstables()
-sstables.sort(key = lambda s : s.key_range()[0])
-for s in sstables:
+with timer.phase('collect'):
+    sstables = cl.collect_sstables()
+    sstables.sort(key = lambda s : s.key_range()[0])
+for s in sstables if not args.quiet else []:
     rng = s.key_range()
     print(f'{s.id():3}: {s.nr_partitions():5} partitions, {s.nr_rows():6} rows, range {rng[0]:6}-{rng[1]:<6}, from {s.origin()}')
 
 print('Splitting sstables into new tablet map')
-split = split_sstables_into_buckets(sstables)
-for r in split:
-    print(f'\t{r[0]} -> {[s.id() for s in r[1]]}')
+stats = bucket_stats()
+buckets = []
+with timer.phase('split'):
+    for r in stats.track(split_sstables_into_buckets(sstables)):
+        if not args.quiet:
+            print(f'\t{r[0]} -> {[s.id() for s in r[1]]}')
+        buckets.append(r[0])
+stats.show()
+
+print('Estimating rewrite cost')
+with timer.phase('rewrite'):
+    plans = [ rewrite_plan(m, candidate_map(m, cl, buckets), sstables, args.row_size) for m in (args.maps or ['split']) ]
+for p in plans:
+    p.show(not args.quiet)
+if len(plans) > 1:
+    print('Candidate maps by bytes read:')
+    for p in sorted(plans, key = lambda p : p.read_bytes()):
+        print(f'\t{p.name()}: read {p.read_bytes()} write {p.write_bytes()} bytes')
+
+if args.reads > 0:
+    with timer.phase('reads'):
+        layouts = [ read_layout('current', cl.tablet_map().keys(), cl.nodes()) ]
+        layouts += [ read_layout(m, candidate_map(m, cl, buckets), cl.nodes()) for m in (args.maps or ['split']) ]
+        simulate_reads(layouts, args.reads)
+
+if args.timing is not None:
+    write_timing(timer, sstables, buckets)
@@ -1,48 +1,189 @@
 #!/usr/bin/env python3
 
+import re
+import os
 import sys
+import json
+import stat
+import math
+import mmap
+import time
+import sqlite3
+import argparse
+
+parser = argparse.ArgumentParser(description='Per-test durations from test.py log')
+parser.add_argument('log', nargs='?', default=None, help='Log file (default stdin)')
+parser.add_argument('--history', default=None, help='Keep durations of runs in this file (.json, otherwise SQLite)')
+parser.add_argument('--run', default=None, help='Name of the run in history (default log file mtime)')
+parser.add_argument('--slowest', type=int, default=None, help='Show only that many slowest tests')
+parser.add_argument('--trend', action='append', default=[], help='Show durations of this test in the last --runs runs (can be repeated)')
+parser.add_argument('--runs', type=int, default=10, help='How many past runs to look at (default 10)')
+parser.add_argument('--threshold', type=float, default=0.2, help='Minimal relative slowdown to report (default 0.2)')
+parser.add_argument('--min-duration', dest='min_duration', type=float, default=1.0, help='Minimal absolute slowdown to report (sec, default 1.0)')
+args = parser.parse_args()
+
+# HH:MM:SS.fff <level> Starting test #N: name
+# HH:MM:SS.fff <level> Test #N succeeded|failed|...
+line_re = re.compile(rb'^(\d+):(\d+):(\d+)\.(\d+) +\S+ +(?:Starting +\S+ +#?(\d+): +(\S+)|Test +#?(\d+) +(\w+))', re.M)
+
+# Timestamps have no date, so going back in time means the next day.
+# Half a day is the biggest backward step that is not considered one.
+day = 24 * 3600
+
+class clock:
+    def __init__(self):
+        self._prev = None
+        self._days = 0
+
+    def time(self, m):
+        t = int(m[1]) * 3600 + int(m[2]) * 60 + int(m[3]) + float(b'0.' + m[4])
+        if self._prev is not None and t < self._prev - day / 2:
+            self._days += 1
+        self._prev = t
+        return t + self._days * day
+
+def parse(data, tests, clk):
+    for m in line_re.finditer(data):
+        ts = clk.time(m)
+        if m[5] is not None:
+            tests[m[5].decode()] = { 'name': m[6].decode(), 'start': ts }
+        else:
+            t = tests.get(m[7].decode())
+            if t is None:
+                print(f'Test #{m[7].decode()} {m[8].decode()} but never started', file=sys.stderr)
+                continue
+            t['end'] = ts
+            t['status'] = m[8].decode()
+
+# Pipes and such are parsed in chunks, the partial last line of a chunk
+# is carried over to the next one
+chunk_size = 4 * 1024 * 1024
+
+def read_stream(f, tests):
+    clk = clock()
+    tail = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        data = tail + chunk
+        cut = data.rfind(b'\n') + 1
+        parse(data[:cut], tests, clk)
+        tail = data[cut:]
+    parse(tail, tests, clk)
+
+def read_log(path, tests):
+    if path is None:
+        read_stream(sys.stdin.buffer, tests)
+        return
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            read_stream(f, tests)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            parse(data, tests, clock())
+
+# Runs are kept in insertion order, every run maps test name to
+# (duration, status)
+class json_history:
+    def __init__(self, path):
+        self._path = path
+        self._runs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._runs = json.load(f)
+
+    def record(self, run, results):
+        self._runs.pop(run, None)
+        self._runs[run] = { n: [ d, s ] for n, (d, s) in results.items() }
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._runs, f)
+        os.replace(tmp, self._path)
+
+    # Durations of successful runs of the test, oldest first
+    def durations(self, name, runs, exclude = None):
+        res = []
+        for run, tests in list(self._runs.items())[-runs - 1:]:
+            if run != exclude and name in tests and tests[name][1] == 'succeeded':
+                res.append((run, tests[name][0]))
+        return res[-runs:]
+
+class sqlite_history:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, recorded REAL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS durations (run INTEGER, test TEXT, duration REAL, status TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS durations_test ON durations (test, run)')
+
+    def record(self, run, results):
+        with self._db:
+            old = self._db.execute('SELECT id FROM runs WHERE name = ?', (run,)).fetchone()
+            if old is not None:
+                self._db.execute('DELETE FROM durations WHERE run = ?', old)
+                self._db.execute('DELETE FROM runs WHERE id = ?', old)
+            rid = self._db.execute('INSERT INTO runs (name, recorded) VALUES (?, ?)', (run, time.time())).lastrowid
+            self._db.executemany('INSERT INTO durations VALUES (?, ?, ?, ?)', [ (rid, n, d, s) for n, (d, s) in results.items() ])
+
+    def durations(self, name, runs, exclude = None):
+        rows = self._db.execute('SELECT runs.name, duration FROM durations JOIN runs ON runs.id = durations.run ' +
+                                'WHERE test = ? AND status = \'succeeded\' AND runs.name IS NOT ? ORDER BY runs.id DESC LIMIT ?', (name, exclude, runs)).fetchall()
+        return list(reversed(rows))
+
+# Student's t 0.975 quantiles for small numbers of degrees of freedom
+t_975 = [ 12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23 ]
+
+# The new duration is a slowdown if it's above the 95% prediction interval
+# of the previous ones and by more than both --threshold and --min-duration
+def slowdown(prev, cur):
+    n = len(prev)
+    if n < 3:
+        return None
+    mean = sum(prev) / n
+    sd = math.sqrt(sum([ (p - mean) ** 2 for p in prev ]) / (n - 1))
+    t = t_975[n - 2] if n - 2 < len(t_975) else 1.96
+    limit = mean + t * sd * math.sqrt(1 + 1 / n)
+    if cur > limit and cur - mean > max(args.min_duration, mean * args.threshold):
+        return (mean, limit)
+    return None
 
 tests = {}
-with sys.stdin as f:
-    for ln in f:
-        x = ln.split()
-        if x[2] == 'Starting':
-            tests[x[4]] = { 'name': x[5], 'ts': x[0] }
-        elif x[2] == 'Test' and x[4] == 'succeeded':
-            if not x[3].startswith('#'):
-                x[3] = '#' + x[3]
-            tests[x[3]+":"]['end'] = x[0]
-
-def toints(ts):
-    x = ts.split('.')
-    y = x[0].split(':')
-    return (int(y[0]), int(y[1]), int(y[2]), int(x[1]))
-
-def timediff(ts, te):
-    tsi = toints(ts)
-    tei = toints(te)
-
-    msd = tei[3] - tsi[3]
-    sd = tei[2] - tsi[2]
-    md = tei[1] - tsi[1]
-    hd = tei[0] - tsi[0]
-
-    if msd < 0:
-        msd += 1000
-        sd -= 1
-    if sd < 0:
-        sd += 60
-        md -= 1
-    if md < 0:
-        md += 60
-        hd -= 1
-
-    return (hd * 60 + md) * 60 + sd
-
-for tn in tests:
-    t = tests[tn]
-    try:
-        x = timediff(t['ts'], t['end'])
-        print("%s: %d sec" % (t['name'], x))
-    except:
-        print("%s: not finished?" % tn)
+read_log(args.log, tests)
+
+results = {}
+for tn, t in tests.items():
+    if 'end' not in t:
+        print(f'{t["name"]} (#{tn}): not finished?')
+        continue
+    d = t['end'] - t['start']
+    if t['name'] not in results or results[t['name']][0] < d:
+        results[t['name']] = (d, t['status'])
+
+ordered = sorted(results.items(), key = lambda r: -r[1][0]) if args.slowest is not None else list(results.items())
+for n, (d, s) in ordered[:args.slowest]:
+    print(f'{n}: {d:.1f} sec' + (f' ({s})' if s != 'succeeded' else ''))
+
+if args.history is None:
+    sys.exit(0)
+
+hist = json_history(args.history) if args.history.endswith('.json') else sqlite_history(args.history)
+run = args.run
+if run is None:
+    run = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.stat(args.log).st_mtime if args.log is not None else time.time()))
+
+slow = []
+for n, (d, s) in results.items():
+    if s != 'succeeded':
+        continue
+    sd = slowdown([ x[1] for x in hist.durations(n, args.runs, run) ], d)
+    if sd is not None:
+        slow.append((n, d, sd))
+hist.record(run, results)
+
+for n in args.trend:
+    print(f'{n}: ' + ' '.join([ f'{d:.1f}' for r, d in hist.durations(n, args.runs) ]))
+
+for n, d, (mean, limit) in sorted(slow, key = lambda x: x[2][0] - x[1]):
+    print(f'SLOWDOWN {n}: {d:.1f} sec, was {mean:.1f} on average (limit {limit:.1f})')
+sys.exit(1 if len(slow) > 0 else 0)